@@ -1,20 +1,35 @@
 #!/usr/bin/env python
 
 
+import atexit
+import collections
 import copy
 import datetime
+import errno
+import fcntl
+import fnmatch
 import functools
+import hashlib
+import heapq
+import imp
 import logging
 import inspect
 import json
+import marshal
 import optparse as op
 import os
 import Queue
+import random
 import re
+import select
 import ssl
 import socket
-import StringIO
+import sqlite3
+import sre_constants as sre
+import sre_parse
+import subprocess
 import sys
+import tempfile
 import threading
 import time
 import traceback
@@ -26,6 +41,110 @@ TRACE = 1
 log = logging.getLogger("main")
 
 
+class QueueHandler(logging.Handler):
+    """\
+    Passes records to a background thread that writes them with the
+    wrapped handler, so a slow disk never blocks dispatch. Messages
+    and tracebacks are rendered before queueing because their
+    arguments may change once the caller moves on; records below the
+    logger's level never get this far and cost nothing to format.
+    """
+
+    def __init__(self, handler):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.q = Queue.Queue()
+        self.t = threading.Thread(target=self.run, args=tuple())
+        self.t.setDaemon(True)
+        self.t.start()
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                formatter = self.handler.formatter or logging.Formatter()
+                record.exc_text = formatter.formatException(record.exc_info)
+                record.exc_info = None
+            self.q.put_nowait(record)
+        except:
+            self.handleError(record)
+
+    def run(self):
+        while True:
+            record = self.q.get()
+            if record is None:
+                return
+            self.handler.handle(record)
+
+    def close(self):
+        if self.t.is_alive():
+            self.q.put(None)
+            self.t.join()
+        self.handler.close()
+        logging.Handler.close(self)
+
+
+class PipeHandler(logging.Handler):
+    "Sends records from a plugin host process back to the bot."
+
+    def __init__(self, send):
+        logging.Handler.__init__(self)
+        self.send = send
+        self.setFormatter(logging.Formatter("%(message)s"))
+
+    def emit(self, record):
+        try:
+            text = self.format(record)
+            self.send({"log": [record.name, record.levelno, text]})
+        except:
+            self.handleError(record)
+
+
+class FlightRecorder(object):
+    """\
+    Ring buffer of the most recent raw lines received and sent and of
+    dispatch decisions. Recording is an append to a bounded deque so it
+    stays on in production; the buffer is written to the log when a
+    handler fails or an owner asks for it. With sample set to N, every
+    Nth event is also logged as it's recorded.
+    """
+
+    def __init__(self, size=1000, sample=0):
+        self.events = collections.deque(maxlen=size)
+        self.sample = sample
+        self.count = 0
+        self.dumped = 0.0
+
+    def record(self, kind, data):
+        self.events.append((time.time(), kind, data))
+        if self.sample:
+            self.count += 1
+            if self.count % self.sample == 0:
+                log.info("SAMPLE %s: %r", kind, data)
+
+    def dump(self, reason, level=logging.ERROR, full=False):
+        """\
+        Log the recorded events. Unless full is set only events since
+        the previous dump are included, so repeated failures don't log
+        the same context over and over.
+        """
+        since = 0.0 if full else self.dumped
+        events = [e for e in list(self.events) if e[0] > since]
+        if events:
+            self.dumped = events[-1][0]
+        lines = ["  {0:.3f} {1} {2!r}".format(*e) for e in events]
+        log.log(level, "Flight recorder, %s (%d events):\n%s",
+                reason, len(lines), "\n".join(lines))
+
+
+class Restart(SystemExit):
+    """\
+    Raised by a handler to replace the running process with a fresh
+    one. The IRC connection is handed over when it's plain TCP.
+    """
+
+
 STYLES = {
     "bold": "\x02",
     "reset": "\x0F",
@@ -63,8 +182,22 @@ STYLES = {
 }
 
 
+RATE_PROFILE = {
+    # Initial and bounding send rates in tokens per second, a line costs
+    # between 0.4 and 3.0 tokens depending on its length.
+    "rate": 1.0,
+    "min_rate": 0.25,
+    "max_rate": 3.0,
+    "burst": 3.0,
+    # Seconds between lag probes and the round trip considered healthy
+    "probe_interval": 30.0,
+    "max_lag": 2.0
+}
+
+
 class Config(object):
     def __init__(self):
+        self.fname = None
         self.data = {
             "logfile": None,
             "host": "irc.freenode.net",
@@ -78,13 +211,39 @@ class Config(object):
             "channels": [],
             "owners": [],
             "plugins": "./plugins",
-            "command_prefix": "."
+            "command_prefix": ".",
+            "transport": "threads",
+            "rate_profiles": {},
+            "alt_nicks": [],
+            "register_timeout": 30,
+            "identify_timeout": 10,
+            "connect_timeout": 30,
+            "ping_timeout": 120,
+            "reconnect": True,
+            "reconnect_delay": 1.0,
+            "reconnect_max_delay": 300.0,
+            "inbound_queue_size": 2000,
+            "inbound_shed_size": 200,
+            "inbound_shed_events": ["JOIN", "PART", "QUIT", "NICK", "MODE"],
+            "lag_warning": 30.0,
+            "flood_rate": 1.0,
+            "flood_burst": 5.0,
+            "ignore": [],
+            "trace_buffer": 1000,
+            "trace_sample": 0,
+            "workers": 4,
+            "worker_queue": 1000,
+            "plugin_queue": 100,
+            "cache_dir": None,
+            "store": "./gizzy.db",
+            "store_delay": 5.0
         }
 
     def load(self, fname):
         if not os.path.exists(fname):
             log.error("Missing config file: {0}".format(fname))
             exit(1)
+        self.fname = os.path.abspath(fname)
         try:
             execfile(fname, self.data)
         except Exception, e:
@@ -115,52 +274,132 @@ class Config(object):
 
     channels = property(_get_channels)
 
+    def _get_rate_profile(self):
+        ret = RATE_PROFILE.copy()
+        profiles = self.data["rate_profiles"]
+        ret.update(profiles.get("default", {}))
+        ret.update(profiles.get(self.data["host"], {}))
+        return ret
+
+    rate_profile = property(_get_rate_profile)
+
+    def _get_cache_dir(self):
+        if self.data["cache_dir"] is None:
+            return os.path.join(self.data["plugins"], "__pycache__")
+        return self.data["cache_dir"]
+
+    cache_dir = property(_get_cache_dir)
+
 
 class Message(object):
+    """\
+    A parsed IRC line. Only the raw line is stored up front, the prefix,
+    arguments and text are split out the first time any of them is read
+    and the source is only broken into nick, user and host on demand.
+    """
+
     SOURCE_RE = re.compile(r'([^!]*)!?([^@]*)@?(.*)')
 
+    __slots__ = (
+        "client",
+        "raw",
+        "received",
+        "_parsed",
+        "_source",
+        "_mask",
+        "_args",
+        "_event",
+        "_target",
+        "_text"
+    )
+
     def __init__(self, client, line):
         self.client = client
         self.raw = line
-        self.source = None
-        self.nick = None
-        self.user = None
-        self.host = None
-        self.args = None
-        self.sender = None
-        self.target = None
-        self.event = None
-        self.text = None
-        self.owner = False
-        self.match = None
-        self.groups = None
-        self.group = None
+        self.received = time.time()
+        self._parsed = False
+        self._mask = None
 
+    def _parse(self):
+        line = self.raw
+        self._source = None
         if line[:1] == u":":
-            self.source, line = line[1:].split(u" ", 1)
-            match = self.SOURCE_RE.match(self.source)
-            self.nick, self.user, self.host = match.groups()
-        else:
-            self.source = None
+            parts = line[1:].split(u" ", 1)
+            self._source = parts[0]
+            line = parts[1] if len(parts) > 1 else u""
 
         if u" :" in line:
-            argstr, self.text = line.split(u" :", 1)
+            argstr, self._text = line.split(u" :", 1)
         else:
-            argstr, self.text = line, u""
-        self.args = argstr.split()
+            argstr, self._text = line, u""
+        self._args = argstr.split()
+
+        self._event = None
+        self._target = None
+        if len(self._args) > 0:
+            self._event = self._args.pop(0)
+        if len(self._args) > 0:
+            self._target = self._args.pop(0)
+        self._parsed = True
+
+    def _split_source(self):
+        if self.source is None:
+            self._mask = (None, None, None)
+        else:
+            self._mask = self.SOURCE_RE.match(self.source).groups()
+        return self._mask
 
-        if len(self.args) > 0:
-            self.event = self.args.pop(0)
-        if len(self.args) > 0:
-            self.target = self.args.pop(0)
+    @property
+    def source(self):
+        if not self._parsed:
+            self._parse()
+        return self._source
 
-        if self.target == self.client.cfg.nick:
-            self.sender = self.nick
-        else:
-            self.sender = self.target
+    @property
+    def args(self):
+        if not self._parsed:
+            self._parse()
+        return self._args
 
-        if self.nick in self.client.cfg.owners:
-            self.owner = True
+    @property
+    def event(self):
+        if not self._parsed:
+            self._parse()
+        return self._event
+
+    @property
+    def target(self):
+        if not self._parsed:
+            self._parse()
+        return self._target
+
+    @property
+    def text(self):
+        if not self._parsed:
+            self._parse()
+        return self._text
+
+    @property
+    def nick(self):
+        return (self._mask or self._split_source())[0]
+
+    @property
+    def user(self):
+        return (self._mask or self._split_source())[1]
+
+    @property
+    def host(self):
+        return (self._mask or self._split_source())[2]
+
+    @property
+    def sender(self):
+        if self.target == self.client.nick:
+            return self.nick
+        return self.target
+
+    @property
+    def owner(self):
+        return self.nick in self.client.cfg.owners
 
     def __str__(self):
         parts = {
@@ -185,14 +424,62 @@ class Message(object):
         self.client.notify(self.sender, text)
 
 
+class Match(object):
+    """\
+    What a handler receives when one of its regexps fires. It carries
+    the match for this invocation and reads everything else from the
+    shared Message, so triggering an action doesn't copy the message.
+    """
+
+    __slots__ = ("msg", "match")
+
+    def __init__(self, msg, match):
+        self.msg = msg
+        self.match = match
+
+    def __getattr__(self, name):
+        return getattr(self.msg, name)
+
+    def __str__(self):
+        return str(self.msg)
+
+    @property
+    def groups(self):
+        return self.match.groups()
+
+    @property
+    def group(self):
+        return self.match.group
+
+
+PATTERNS = {}
+
+
+def compile_pattern(pattern, flags=0):
+    "re.compile() behind a cache that, unlike re's own, is never purged."
+    regexp = PATTERNS.get((pattern, flags))
+    if regexp is None:
+        regexp = PATTERNS[(pattern, flags)] = re.compile(pattern, flags)
+    return regexp
+
+
 class Action(object):
-    def __init__(self, event='PRIVMSG', require_owner=False):
+    ORDERS = (None, "target", "nick")
+
+    def __init__(self, event='PRIVMSG', require_owner=False, inline=False,
+            order=None):
+        if order not in self.ORDERS:
+            raise ValueError("Invalid action order: {0}".format(order))
         self.event = event
         self.require_owner = require_owner
+        self.inline = inline
+        self.order = order
         self.func = None
         self.docs = None
         self.regexps = []
         self.name = None
+        self.literal = None
+        self.matchall = False
 
     def __call__(self, func):
         if func.__doc__:
@@ -206,26 +493,45 @@ class Action(object):
             raise ValueError("Invalid action argspec")
         return self
 
-    def compile(self, cfg):
+    def compile(self, cfg, nick):
+        "Build the regexps for the bot's current nick, again if it changes."
         raise NotImplemented
 
-    def handle(self, msg, state):
+    def handle(self, msg, state, regexps=None):
+        for match in self.matches(msg, regexps):
+            self.call(match, state)
+
+    def matches(self, msg, regexps=None):
+        # A list rather than a generator so the StopIteration for a
+        # refused owner command reaches the plugin manager.
         if msg.event != self.event and self.event != '*':
-            return
-        msg = copy.copy(msg)
-        for regexp in self.regexps:
+            return []
+        if regexps is None:
+            regexps = self.regexps
+        found = []
+        for regexp in regexps:
             match = regexp.search(msg.text)
             if not match:
                 continue
             if self.require_owner and not msg.owner:
                 msg.respond("You are not an owner of this bot.")
                 raise StopIteration
-            args = (self.name, msg.text, regexp.pattern)
-            log.debug("Action triggered: {0} {1} {2}".format(*args))
-            msg.match = match
-            msg.groups = match.groups()
-            msg.group = match.group
-            self.func(msg, state)
+            found.append(Match(msg, match))
+        return found
+
+    def call(self, match, state):
+        log.debug("Action triggered: %s %s %s",
+                self.name, match.text, match.match.re.pattern)
+        match.client.recorder.record("CALL", self.name)
+        self.func(match, state)
+
+    def key(self, msg):
+        "The ordering key for calls to this action, None if unordered."
+        if self.order == "target":
+            return msg.sender
+        elif self.order == "nick":
+            return msg.nick
+        return None
 
 
 class Command(Action):
@@ -236,12 +542,17 @@ class Command(Action):
         super(Command, self).__init__(**kwargs)
         self.cmd = cmd
         self.name = " ".join(cmd)
+        self.word = None
 
-    def compile(self, cfg):
-        prefixes = [
+    @staticmethod
+    def prefixes(cfg):
+        return [
             "^$nick[,:]?\s+",
             "^" + re.escape(cfg.command_prefix)
         ]
+
+    def compile(self, cfg, nick):
+        self.regexps = []
         parts = []
         for c in self.cmd:
             match = self.ARG_RE.match(c)
@@ -255,30 +566,565 @@ class Command(Action):
                 else:
                     parts.append("(?P<{0}>\S+)".format(name))
         cmd = "\s+".join(parts)
-        for p in prefixes:
-            pattern = (p + cmd + "$").replace("$nick", re.escape(cfg.nick))
-            self.regexps.append(re.compile(pattern.decode("utf-8")))
+        for p in self.prefixes(cfg):
+            pattern = (p + cmd + "$").replace("$nick", re.escape(nick))
+            self.regexps.append(compile_pattern(pattern.decode("utf-8")))
+        # Commands that start with a plain word can be found by looking
+        # that word up in the plugin manager's index. Anything else
+        # (a leading argument, or a case folding pattern) gets scanned.
+        first = self.cmd[0] if self.cmd else ""
+        folded = any(r.flags & re.IGNORECASE for r in self.regexps)
+        if first.split() and not self.ARG_RE.match(first) and not folded:
+            self.word = first.split()[0].decode("utf-8")
 
 
 class Rule(Action):
+    ANALYSIS = {}
+
     def __init__(self, pattern, name=None, **kwargs):
         super(Rule, self).__init__(**kwargs)
+        self.source = pattern
         self.pattern = pattern
         if name is None:
             self.name = self.pattern
 
-    def compile(self, cfg):
-        self.pattern = self.pattern.replace("$nick", re.escape(cfg.nick))
+    def compile(self, cfg, nick):
+        self.pattern = self.source.replace("$nick", re.escape(nick))
         self.pattern = self.pattern.decode("utf-8")
-        self.regexps.append(re.compile(self.pattern))
+        regexp = compile_pattern(self.pattern)
+        self.regexps = [regexp]
+        # The longest piece of text every match must contain lets the
+        # plugin manager skip this rule for lines that don't have it.
+        if self.pattern not in self.ANALYSIS:
+            parsed = sre_parse.parse(self.pattern)
+            (literal, matchall) = (None, self.matches_all(parsed))
+            if not matchall and not regexp.flags & re.IGNORECASE:
+                literal = self.required(parsed) or None
+            self.ANALYSIS[self.pattern] = (literal, matchall)
+        (self.literal, self.matchall) = self.ANALYSIS[self.pattern]
+
+    @classmethod
+    def required(cls, items):
+        best = u""
+        run = []
+        items = list(items)
+        while items:
+            (op, av) = items.pop(0)
+            if op == sre.LITERAL:
+                run.append(unichr(av))
+                continue
+            elif op == sre.SUBPATTERN:
+                items[0:0] = list(av[-1])
+                continue
+            elif op == sre.AT:
+                continue
+            best = max(best, u"".join(run), key=len)
+            run = []
+            if op in (sre.MAX_REPEAT, sre.MIN_REPEAT) and av[0] > 0:
+                best = max(best, cls.required(av[2]), key=len)
+        return max(best, u"".join(run), key=len)
+
+    @classmethod
+    def matches_all(cls, items):
+        anchors = (sre.AT_BEGINNING, sre.AT_BEGINNING_STRING,
+                sre.AT_END, sre.AT_END_STRING)
+        for (op, av) in items:
+            if op == sre.AT and av in anchors:
+                continue
+            elif op in (sre.MAX_REPEAT, sre.MIN_REPEAT) and av[0] == 0:
+                continue
+            elif op == sre.SUBPATTERN and cls.matches_all(av[-1]):
+                continue
+            return False
+        return True
+
+
+class Job(object):
+    "A call waiting in the Scheduler, see Schedule."
+
+    def __init__(self, owner, delay, interval, func, args, kwargs):
+        self.owner = owner
+        self.due = time.time() + delay
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.name = getattr(func, "__name__", "job")
+
+    @property
+    def pending(self):
+        return not self.cancelled
+
+    def cancel(self):
+        "Stop the job, returns False if it was already cancelled or done."
+        return self.owner.cancel(self)
+
+
+class Scheduler(object):
+    """\
+    One thread with a heap of due times runs every plugin's timed jobs,
+    instead of a thread per threading.Timer. Cancelled jobs are left in
+    the heap and skipped when they come up.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = 0
+        self.thread = None
+
+    def add(self, job):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                        name="scheduler")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.seq += 1
+            heapq.heappush(self.heap, (job.due, self.seq, job))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    wait = self.heap[0][0] - now if self.heap else None
+                    self.cond.wait(wait)
+                (_, _, job) = heapq.heappop(self.heap)
+            if job.cancelled:
+                continue
+            if job.interval is not None:
+                # Keep to the original cadence unless we've fallen behind
+                job.due = max(job.due + job.interval, now)
+                self.add(job)
+            job.owner.run(job)
+
+
+SCHEDULER = Scheduler()
+
+
+class Schedule(object):
+    """\
+    Available to plugins as `schedule`. Jobs run like the plugin's other
+    handlers, so they never overlap with them unless the plugin allows
+    concurrency, and anything still pending is cancelled on unload.
+    """
+
+    def __init__(self, plugin, scheduler):
+        self.plugin = plugin
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.jobs = set()
+
+    def after(self, delay, func, *args, **kwargs):
+        "Call func(*args, **kwargs) once, delay seconds from now."
+        return self.add(Job(self, delay, None, func, args, kwargs))
+
+    def every(self, interval, func, *args, **kwargs):
+        "Call func(*args, **kwargs) every interval seconds until cancelled."
+        return self.add(Job(self, interval, interval, func, args, kwargs))
+
+    def add(self, job):
+        with self.lock:
+            self.jobs.add(job)
+        self.scheduler.add(job)
+        return job
+
+    def cancel(self, job):
+        with self.lock:
+            if job not in self.jobs:
+                return False
+            self.jobs.discard(job)
+            job.cancelled = True
+            return True
+
+    def adopt(self, other, rebind):
+        "Take over another copy of the plugin's pending jobs."
+        with other.lock:
+            with self.lock:
+                for job in other.jobs:
+                    job.owner = self
+                    job.func = rebind(job.func)
+                    self.jobs.add(job)
+                other.jobs = set()
+
+    def run(self, job):
+        with self.lock:
+            owner = job.owner
+            if owner is self and job.interval is None:
+                if job not in self.jobs:
+                    return
+                self.jobs.discard(job)
+                job.cancelled = True
+        if owner is not self:
+            # Handed over to a reloaded copy of the plugin
+            return owner.run(job)
+        pool = self.plugin.pool
+        if pool is None:
+            self.call(job)
+        else:
+            pool.put(self.plugin, None, functools.partial(self.call, job))
+
+    def call(self, job):
+        try:
+            job.func(*job.args, **job.kwargs)
+        except:
+            log.exception("Error in scheduled job: {0}".format(job.name))
+
+    def clear(self):
+        for job in list(self.jobs):
+            job.cancel()
+
+
+class Subscription(object):
+    "A plugin's standing request for messages, see Subscriptions."
+
+    def __init__(self, owner, ident, keys, func, once=False, inline=False):
+        self.owner = owner
+        self.id = ident
+        self.keys = keys
+        self.func = func
+        self.once = once
+        self.inline = inline
+        self.timer = None
+        self.name = getattr(func, "__name__", "subscription")
+        self.callback = func
+        self.created = time.time()
+
+    def cancel(self):
+        "Stop receiving messages, returns False if already cancelled."
+        return self.owner.cancel(self)
+
+
+class Subscriptions(object):
+    """\
+    Available to plugins as `subscribe`. A rule that matches everything
+    runs for every line in every channel; a subscription is found by a
+    dict lookup on the line's channel or sender and costs nothing while
+    the plugin isn't listening. Handlers take `(msg)` or `(msg, state)`
+    like actions, but get the Message itself since there's no match.
+    """
+
+    def __init__(self, plugin, router):
+        self.plugin = plugin
+        self.router = router
+        self.lock = threading.Lock()
+        self.subs = {}
+        self.last_id = 0
+
+    def private(self, func, nicks=None):
+        "Receive private messages from nicks, or from anyone."
+        if nicks is None:
+            keys = [("private", "*")]
+        else:
+            keys = [("private", n.lower()) for n in nicks]
+        return self.add(keys, func)
+
+    def channel(self, func, channel):
+        "Receive every message said in channel."
+        return self.add([("channel", channel.lower())], func)
+
+    def reply(self, func, nick, timeout=None, expired=None):
+        """\
+        Receive the next message from nick, privately or in a channel.
+        If nothing arrives in timeout seconds expired is called instead.
+        """
+        sub = self.add([("reply", nick.lower())], func, once=True)
+        if timeout is not None:
+            schedule = self.plugin.schedule
+            sub.timer = schedule.after(timeout, self.expire, sub, expired)
+        return sub
+
+    def add(self, keys, func, once=False, ident=None, inline=False):
+        handler = self.handler(func)
+        with self.lock:
+            if ident is None:
+                self.last_id += 1
+                ident = self.last_id
+            sub = Subscription(self, ident, keys, handler, once, inline)
+            sub.name = getattr(func, "__name__", sub.name)
+            sub.callback = func
+            self.subs[ident] = sub
+        self.router.subscribe(sub)
+        return sub
+
+    @staticmethod
+    def handler(func):
+        args = inspect.getargspec(func)[0]
+        if inspect.ismethod(func):
+            args = args[1:]
+        if len(args) == 1:
+            return lambda m, s: func(m)
+        elif len(args) == 2:
+            return func
+        raise ValueError("Invalid subscription argspec")
+
+    def adopt(self, other, rebind):
+        "Take over another copy of the plugin's subscriptions."
+        with other.lock:
+            (subs, other.subs) = (other.subs, {})
+        with self.lock:
+            for sub in subs.itervalues():
+                sub.owner = self
+                sub.callback = rebind(sub.callback)
+                sub.func = self.handler(sub.callback)
+                self.subs[sub.id] = sub
+            self.last_id = max([self.last_id] + subs.keys())
+
+    def cancel(self, sub):
+        with self.lock:
+            if self.subs.pop(sub.id, None) is None:
+                return False
+        if sub.timer is not None:
+            sub.timer.cancel()
+        self.router.unsubscribe(sub)
+        return True
+
+    def expire(self, sub, expired):
+        if not self.cancel(sub) or expired is None:
+            return
+        try:
+            expired()
+        except:
+            log.exception("Error in subscription timeout: {0}".format(
+                    sub.name))
+
+    def clear(self):
+        for sub in self.subs.values():
+            sub.cancel()
+
+
+class Storage(object):
+    """\
+    The sqlite file behind every plugin's `store`. Reads are served from
+    a copy of each plugin's values loaded on first use, and writes change
+    that copy and are saved by a background thread in one transaction,
+    at most delay seconds later. With no path nothing is saved.
+    """
+
+    def __init__(self, path, delay):
+        self.path = path
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.dblock = threading.Lock()
+        self.db = None
+        self.cache = {}
+        self.dirty = {}
+        self.thread = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS store ("
+                    "plugin TEXT, key TEXT, value TEXT, "
+                    "PRIMARY KEY (plugin, key))")
+        return self.db
+
+    def values(self, name):
+        with self.cond:
+            if name in self.cache:
+                return self.cache[name]
+        values = {}
+        if self.path:
+            with self.dblock:
+                rows = self.connect().execute("SELECT key, value FROM store "
+                        "WHERE plugin = ?", (name,)).fetchall()
+            values = dict((k, json.loads(v)) for (k, v) in rows)
+        with self.cond:
+            return self.cache.setdefault(name, values)
+
+    def put(self, name, key, value):
+        # Fails here rather than in the writer for values JSON can't hold
+        text = json.dumps(value)
+        values = self.values(name)
+        with self.cond:
+            values[key] = json.loads(text)
+            self.changed(name, key, text)
+
+    def remove(self, name, key):
+        values = self.values(name)
+        with self.cond:
+            if key not in values:
+                return False
+            del values[key]
+            self.changed(name, key, None)
+            return True
+
+    def changed(self, name, key, text):
+        if not self.path:
+            return
+        self.dirty[(name, key)] = text
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="storage")
+            self.thread.setDaemon(True)
+            self.thread.start()
+            atexit.register(self.flush)
+        self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+            time.sleep(self.delay)
+            self.flush()
+
+    def flush(self):
+        "Save pending writes now."
+        with self.dblock:
+            with self.cond:
+                (batch, self.dirty) = (self.dirty, {})
+            if not batch:
+                return
+            saved = [(n, k, v) for ((n, k), v) in batch.iteritems()
+                    if v is not None]
+            removed = [(n, k) for ((n, k), v) in batch.iteritems()
+                    if v is None]
+            try:
+                with self.connect() as db:
+                    db.executemany("INSERT OR REPLACE INTO store "
+                            "VALUES (?, ?, ?)", saved)
+                    db.executemany("DELETE FROM store "
+                            "WHERE plugin = ? AND key = ?", removed)
+            except sqlite3.Error:
+                log.exception("Error saving plugin store, will retry")
+                with self.cond:
+                    for (k, v) in batch.iteritems():
+                        self.dirty.setdefault(k, v)
+
+
+class Store(object):
+    """\
+    Available to plugins as `store`, a dict like set of values that lasts
+    across reloads and restarts. Values are anything JSON can hold and
+    are copied when set, so set a value again after changing it. Reads
+    never touch the disk after the first and writes are saved in the
+    background, so handlers can use it freely.
+    """
+
+    def __init__(self, plugin, storage):
+        self.plugin = plugin
+        self.storage = storage
+
+    def key(self, key):
+        if isinstance(key, str):
+            key = key.decode("utf-8")
+        if not isinstance(key, unicode):
+            raise TypeError("Store keys must be strings: {0!r}".format(key))
+        return key
+
+    @property
+    def values(self):
+        return self.storage.values(self.plugin.name)
+
+    def get(self, key, default=None):
+        return self.values.get(self.key(key), default)
+
+    def keys(self):
+        return self.values.keys()
+
+    def __getitem__(self, key):
+        return self.values[self.key(key)]
+
+    def __setitem__(self, key, value):
+        self.storage.put(self.plugin.name, self.key(key), value)
+
+    def __delitem__(self, key):
+        if not self.storage.remove(self.plugin.name, self.key(key)):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.key(key) in self.values
+
+    def flush(self):
+        "Save pending writes now, this happens on unload anyway."
+        self.storage.flush()
+
+
+def declares(fname, flag):
+    "Whether a plugin sets a module level flag to True, without running it."
+    pattern = compile_pattern(r"^{0}\s*=\s*True\b".format(flag), re.M)
+    with open(fname) as handle:
+        return pattern.search(handle.read()) is not None
+
+
+def defines(fname, func):
+    "Whether a plugin has a module level function, without running it."
+    pattern = compile_pattern(r"^def\s+{0}\s*\(".format(func), re.M)
+    with open(fname) as handle:
+        return pattern.search(handle.read()) is not None
+
+
+class CodeCache(object):
+    """\
+    Compiled plugin code kept on disk so loading a plugin doesn't have
+    to parse it again. Entries are keyed by a hash of the file's path
+    and contents and the interpreter's bytecode magic, so an edit or an
+    upgrade just misses the cache. With no path it only compiles.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, fname):
+        with open(fname, "rb") as handle:
+            source = handle.read()
+        if not self.path:
+            self.misses += 1
+            return compile(source, fname, "exec", 0, True)
+        key = hashlib.sha1(imp.get_magic() + fname + "\0" + source)
+        name = os.path.splitext(os.path.basename(fname))[0]
+        cached = os.path.join(self.path,
+                "{0}-{1}.code".format(name, key.hexdigest()))
+        try:
+            with open(cached, "rb") as handle:
+                code = marshal.load(handle)
+            self.hits += 1
+            return code
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        code = compile(source, fname, "exec", 0, True)
+        self.misses += 1
+        self.store(name, cached, code)
+        return code
+
+    def store(self, name, cached, code):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            for old in os.listdir(self.path):
+                if old.startswith(name + "-") and old.endswith(".code"):
+                    os.unlink(os.path.join(self.path, old))
+            (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "wb") as handle:
+                marshal.dump(code, handle)
+            os.rename(tmp, cached)
+        except (IOError, OSError), e:
+            log.warning("Can't cache compiled plugin: {0}".format(e))
 
 
 class Plugin(object):
     def __init__(self, cfg, cli, plugin_mgr, fname):
         self.cfg = cfg
         self.fname = fname
+        self.manager = plugin_mgr
+        self.cli = cli
+        self.nick = None
         self.state = None
         self.actions = []
+        self.concurrency = 1
+        self.signature = None
+        self.code = plugin_mgr.code if plugin_mgr else CodeCache(None)
+        self.subscriptions = Subscriptions(self, plugin_mgr)
+        self.schedule = Schedule(self, SCHEDULER)
+        storage = plugin_mgr.storage if plugin_mgr else Storage(None, 0)
+        self.store = Store(self, storage)
         self.data = copy.copy(globals())
         self.data.update({
             "irc": cli,
@@ -286,36 +1132,141 @@ class Plugin(object):
             "log": self._get_logger(),
             "config": self.cfg,
             "command": Command,
-            "rule": Rule
+            "rule": Rule,
+            "subscribe": self.subscriptions,
+            "schedule": self.schedule,
+            "store": self.store
         })
         if not os.path.exists(self.fname):
             raise ValueError("Plugin not found: {0}".format(self.fname))
 
     def load(self):
-        execfile(self.fname, self.data)
+        self.compile()
+        self.start()
+
+    def compile(self):
+        exec self.code.load(self.fname) in self.data
+
+    def start(self):
         if callable(self.data.get("load")):
             self.state = self.data["load"]()
+        self.collect()
+
+    def collect(self):
+        self.concurrency = max(1, int(self.data.get("concurrency", 1)))
         for (k, v) in self.data.iteritems():
             if isinstance(v, Action):
-                v.compile(self.cfg)
                 self.actions.append(v)
+        self.renick(self.cli.nick)
+
+    def renick(self, nick):
+        "Recompile the actions' regexps for a new nick."
+        self.nick = nick
+        for a in self.actions:
+            a.compile(self.cfg, nick)
+
+    def reload(self, previous):
+        """\
+        Load this copy of the plugin in place of previous. If the new code
+        has a `reload(old_state)` hook it's handed the old state, and the
+        old copy's jobs and subscriptions carry over, calling functions of
+        the same name in the new code. Returns False without touching
+        previous if there's no hook, the caller then unloads it and calls
+        start() as for a fresh load.
+        """
+        self.compile()
+        hook = self.data.get("reload")
+        if not callable(hook) or isinstance(hook, Action):
+            return False
+        moved = {
+            previous.subscriptions: self.subscriptions,
+            previous.schedule: self.schedule
+        }
+
+        def rebind(func):
+            name = getattr(func, "__name__", None)
+            if getattr(func, "im_self", None) in moved:
+                return getattr(moved[func.im_self], name)
+            if name is not None and previous.data.get(name) is func:
+                return self.data.get(name, func)
+            return func
+
+        self.subscriptions.adopt(previous.subscriptions, rebind)
+        self.schedule.adopt(previous.schedule, rebind)
+        try:
+            self.state = hook(previous.state)
+        except:
+            self.subscriptions.clear()
+            self.schedule.clear()
+            raise
+        self.collect()
+        return True
 
     def unload(self):
-        if callable(self.data.get("unload")):
-            self.data["unload"](self.state)
+        self.subscriptions.clear()
+        self.schedule.clear()
+        try:
+            if callable(self.data.get("unload")):
+                self.data["unload"](self.state)
+        finally:
+            self.store.flush()
 
     def handle(self, msg):
         for a in self.actions:
-            try:
-                a.handle(msg, self.state)
-            except SystemExit:
-                raise
-            except KeyboardInterrupt:
-                raise
-            except StopIteration:
-                raise
-            except:
-                log.exception("Error handling msg: {0}".format(msg))
+            self.run(a, msg)
+
+    @property
+    def pool(self):
+        return self.manager.pool if self.manager else None
+
+    def run(self, action, msg, regexps=None):
+        pool = self.pool
+        try:
+            for match in action.matches(msg, regexps):
+                if action.inline or pool is None:
+                    action.call(match, self.state)
+                else:
+                    call = functools.partial(self.call, action, match)
+                    pool.put(self, action.key(msg), call)
+        except SystemExit:
+            raise
+        except KeyboardInterrupt:
+            raise
+        except StopIteration:
+            raise
+        except:
+            self.failed(action, msg)
+
+    def call(self, action, match):
+        # Runs on a worker, where there is no dispatch left to stop
+        try:
+            action.call(match, self.state)
+        except StopIteration:
+            pass
+        except:
+            self.failed(action, match.msg)
+
+    def deliver(self, sub, msg):
+        if sub.once and not sub.cancel():
+            return
+        pool = self.pool
+        if sub.inline or pool is None:
+            self.notify(sub, msg)
+        else:
+            pool.put(self, None, functools.partial(self.notify, sub, msg))
+
+    def notify(self, sub, msg):
+        try:
+            msg.client.recorder.record("CALL", sub.name)
+            sub.func(msg, self.state)
+        except StopIteration:
+            pass
+        except:
+            self.failed(sub, msg)
+
+    def failed(self, action, msg):
+        log.exception("Error handling msg: {0}".format(msg))
+        msg.client.recorder.dump("{0} failed".format(action.name))
 
     @property
     def name(self):
@@ -328,116 +1279,1262 @@ class Plugin(object):
         return logging.getLogger(name)
 
 
+class PluginHost(Plugin):
+    """\
+    A plugin that sets `isolate = True` is loaded in a child process
+    so its CPU time, memory and crashes stay away from the connection.
+    The bot keeps stand-in actions built from the child's description
+    of its commands and rules; when one matches, the raw line is sent
+    down a pipe and the child runs the real handler. Output and log
+    records come back up the pipe as JSON lines.
+    """
+
+    def __init__(self, cfg, cli, plugin_mgr, fname):
+        super(PluginHost, self).__init__(cfg, cli, plugin_mgr, fname)
+        self.data = {}
+        self.proc = None
+        self.lock = threading.Lock()
+        self.replies = None
+        self.restarting = None
+        self.unloaded = False
+
+    def load(self):
+        self.describe(self.start())
+
+    def reload(self, previous):
+        """\
+        Reload the plugin's code in its own process, where the plugin's
+        reload hook, if any, can keep its state. previous is this host.
+        """
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                raise ValueError("Plugin host is not running")
+            self.replies = Queue.Queue()
+            try:
+                self.proc.stdin.write(json.dumps({"reload": True}) + "\n")
+                self.proc.stdin.flush()
+                desc = self.replies.get()
+            finally:
+                self.replies = None
+        if "error" in desc:
+            raise ValueError("Plugin host failed: {0}".format(desc["error"]))
+        self.describe(desc)
+        return True
+
+    def describe(self, desc):
+        actions = []
+        self.data["__doc__"] = desc["doc"]
+        for (i, a) in enumerate(desc["actions"]):
+            kwargs = {
+                "event": a["event"],
+                "require_owner": a["require_owner"],
+                "inline": True
+            }
+            if a["kind"] == "command":
+                proxy = Command([c.encode("utf-8") for c in a["spec"]],
+                        **kwargs)
+            else:
+                proxy = Rule(a["spec"].encode("utf-8"), **kwargs)
+            proxy.name = a["name"]
+            proxy.docs = a["docs"]
+            proxy.func = functools.partial(self.forward, i)
+            proxy.compile(self.cfg, self.cli.nick)
+            actions.append(proxy)
+        self.nick = self.cli.nick
+        self.actions = actions
+
+    def unload(self):
+        self.subscriptions.clear()
+        with self.lock:
+            proc, self.proc = self.proc, None
+            self.unloaded = True
+        if proc is None or proc.poll() is not None:
+            return
+        try:
+            proc.stdin.write(json.dumps({"unload": True}) + "\n")
+            proc.stdin.close()
+        except IOError:
+            pass
+        deadline = time.time() + 5.0
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if proc.poll() is None:
+            log.warning("Killing plugin host for {0}".format(self.name))
+            proc.kill()
+            proc.wait()
+
+    def start(self):
+        # Subscriptions belonged to the previous process, if any
+        self.subscriptions.clear()
+        argv = [sys.executable, os.path.abspath(__file__)]
+        argv.extend(["--host", self.fname])
+        if self.cfg.fname is not None:
+            argv.extend(["-c", self.cfg.fname])
+        proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, close_fds=True)
+        # Log records can arrive before the description of the actions
+        desc = {"error": "host exited"}
+        for line in iter(proc.stdout.readline, ""):
+            reply = json.loads(line)
+            if "actions" in reply or "error" in reply:
+                desc = reply
+                break
+            self.handle_reply(reply)
+        if "error" in desc:
+            proc.stdin.close()
+            proc.wait()
+            raise ValueError("Plugin host failed: {0}".format(desc["error"]))
+        t = threading.Thread(target=self.relay, args=(proc,))
+        t.setDaemon(True)
+        t.start()
+        with self.lock:
+            if not self.unloaded:
+                self.proc = proc
+        if self.proc is not proc:
+            proc.kill()
+            proc.wait()
+            raise ValueError("Plugin unloaded while its host started")
+        log.info("Started plugin host for {0}: pid {1}".format(
+                self.name, proc.pid))
+        return desc
+
+    def relay(self, proc):
+        for line in iter(proc.stdout.readline, ""):
+            try:
+                self.handle_reply(json.loads(line))
+            except:
+                log.exception("Bad reply from plugin host: {0!r}".format(line))
+        if self.replies is not None:
+            self.replies.put({"error": "host exited"})
+        code = proc.wait()
+        if proc is self.proc:
+            log.error("Plugin host for {0} exited with {1}".format(
+                    self.name, code))
+
+    def handle_reply(self, reply):
+        if "actions" in reply or "error" in reply:
+            # Answer to a reload, see reload()
+            if self.replies is not None:
+                self.replies.put(reply)
+        elif "write" in reply:
+            (args, text) = reply["write"]
+            self.cli.write(tuple(args), text)
+        elif "log" in reply:
+            (name, level, text) = reply["log"]
+            logging.getLogger(name).log(level, "%s", text)
+        elif "subscribe" in reply:
+            (ident, keys, once) = reply["subscribe"]
+            func = lambda m, s: self.send_message(ident, m)
+            keys = [tuple(k) for k in keys]
+            self.subscriptions.add(keys, func, once, ident, inline=True)
+        elif "unsubscribe" in reply:
+            sub = self.subscriptions.subs.get(reply["unsubscribe"])
+            if sub is not None:
+                sub.cancel()
+
+    def forward(self, i, match, state):
+        action = self.actions[i]
+        req = {
+            "call": i,
+            "regexp": action.regexps.index(match.match.re),
+            "raw": match.raw,
+            "nick": match.client.nick
+        }
+        self.send(req)
+
+    def send_message(self, ident, msg):
+        req = {"deliver": ident, "raw": msg.raw, "nick": msg.client.nick}
+        self.send(req, restart=False)
+
+    def send(self, req, restart=True):
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                if restart and not self.unloaded:
+                    self.restart()
+                return
+            try:
+                self.proc.stdin.write(json.dumps(req) + "\n")
+                self.proc.stdin.flush()
+            except IOError:
+                log.exception("Error writing to plugin host")
+
+
+    def restart(self):
+        # Called with the lock held. Starting waits for the plugin to
+        # load, which mustn't hold up dispatch, see PluginManager.defer
+        if self.restarting is not None:
+            return
+        log.warning("Restarting plugin host for {0}, dropping calls until "
+                "it's ready".format(self.name))
+        name = "restart-{0}".format(self.name)
+        self.restarting = threading.Thread(target=self.respawn, name=name)
+        self.restarting.setDaemon(True)
+        self.restarting.start()
+
+    def respawn(self):
+        try:
+            self.start()
+        except:
+            log.exception("Error restarting plugin host for {0}".format(
+                    self.name))
+        finally:
+            with self.lock:
+                self.restarting = None
+
+
+class FloodGuard(object):
+    """\
+    Cheap per source admission check in front of the plugins. Anything
+    from a hostmask matching an ignore pattern is dropped, and every
+    other user gets a token bucket keyed by host (or nick when the host
+    is hidden) so one noisy source can't monopolise dispatch. Owners
+    and server messages are never limited.
+    """
+
+    def __init__(self, cfg):
+        self.rate = cfg.flood_rate
+        self.burst = cfg.flood_burst
+        self.ignore = None
+        if cfg.ignore:
+            masks = [fnmatch.translate(m.lower()) for m in cfg.ignore]
+            self.ignore = re.compile("|".join(masks))
+        self.buckets = {}
+        self.ignored = collections.defaultdict(int)
+        self.limited = collections.defaultdict(int)
+        self.last_prune = time.time()
+
+    def allow(self, msg):
+        if not msg.user or msg.owner:
+            return True
+        if self.ignore is not None and self.ignore.match(msg.source.lower()):
+            self.ignored[msg.source] += 1
+            return False
+        now = time.time()
+        if now - self.last_prune > 60.0:
+            self.prune(now)
+        key = (msg.host or msg.nick).lower()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        if bucket.delay(1.0, now) > 0:
+            if not self.limited[key]:
+                log.info("Rate limiting messages from {0}".format(msg.source))
+            self.limited[key] += 1
+            return False
+        bucket.take(1.0)
+        return True
+
+    def prune(self, now):
+        # A bucket that has refilled completely is the same as a new one
+        for (key, bucket) in self.buckets.items():
+            if bucket.delay(bucket.burst, now) == 0:
+                del self.buckets[key]
+                self.limited.pop(key, None)
+        self.last_prune = now
+
+    def stats(self):
+        "Return (ignored counts by source, limited counts by host)."
+        return (dict(self.ignored), dict(self.limited))
+
+
+class WorkerPool(object):
+    """\
+    Runs plugin handlers off the message loop so a slow one can't hold
+    up PINGs or other channels. A plugin has at most `concurrency` calls
+    running at once, one unless it asks for more, and calls that share
+    an ordering key run one at a time in the order they arrived. Adding
+    never blocks: a plugin with plugin_limit calls waiting, or a pool
+    with limit, has further calls dropped with a warning, so one hung
+    plugin can't stop the message loop or the scheduler.
+    """
+
+    def __init__(self, size, limit, plugin_limit):
+        self.cond = threading.Condition()
+        self.pending = collections.deque()
+        # A plugin never gets every worker, someone else may need one
+        self.share = max(1, size - 1)
+        self.limit = limit
+        self.plugin_limit = plugin_limit
+        self.queued = collections.defaultdict(int)
+        self.dropped = collections.defaultdict(int)
+        self.warned = 0.0
+        self.running = collections.defaultdict(int)
+        self.busy = set()
+        self.threads = []
+        for i in range(size):
+            t = threading.Thread(target=self.run, name="worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def __len__(self):
+        with self.cond:
+            return len(self.pending)
+
+    def put(self, plugin, key, func):
+        "Queue a call, returns False if it was dropped."
+        with self.cond:
+            if len(self.pending) >= self.limit \
+                    or self.queued[plugin] >= self.plugin_limit:
+                self.drop(plugin)
+                return False
+            self.pending.append((plugin, key, func))
+            self.queued[plugin] += 1
+            self.cond.notify_all()
+            return True
+
+    def drop(self, plugin):
+        self.dropped[plugin.name] += 1
+        now = time.time()
+        if now - self.warned < 60:
+            return
+        self.warned = now
+        counts = ", ".join("{0}: {1}".format(n, c)
+                for (n, c) in sorted(self.dropped.items()))
+        log.warning("Worker queue full, dropped calls ({0}), {1} waiting "
+                "for {2}".format(counts, self.queued[plugin], plugin.name))
+
+    def cancel(self, plugin):
+        "Forget calls that haven't started for an unloaded plugin."
+        with self.cond:
+            kept = [t for t in self.pending if t[0] is not plugin]
+            self.pending = collections.deque(kept)
+            self.queued.pop(plugin, None)
+            self.cond.notify_all()
+
+    def take(self):
+        for (i, task) in enumerate(self.pending):
+            (plugin, key, _) = task
+            if self.running[plugin] >= min(plugin.concurrency, self.share):
+                continue
+            if key is not None and (plugin, key) in self.busy:
+                continue
+            del self.pending[i]
+            self.queued[plugin] -= 1
+            if not self.queued[plugin]:
+                del self.queued[plugin]
+            return task
+        return None
+
+    def run(self):
+        while True:
+            with self.cond:
+                task = self.take()
+                while task is None:
+                    self.cond.wait()
+                    task = self.take()
+                (plugin, key, func) = task
+                self.running[plugin] += 1
+                self.busy.add((plugin, key))
+                self.cond.notify_all()
+            try:
+                func()
+            except:
+                log.exception("Error running handler")
+            finally:
+                with self.cond:
+                    self.running[plugin] -= 1
+                    if not self.running[plugin]:
+                        del self.running[plugin]
+                    self.busy.discard((plugin, key))
+                    self.cond.notify_all()
+
+    def stats(self):
+        """\
+        Return (queued calls, running calls by plugin name, dropped calls
+        by plugin name).
+        """
+        with self.cond:
+            running = dict((p.name, n) for (p, n) in self.running.items())
+            return (len(self.pending), running, dict(self.dropped))
+
+
 class PluginManager(object):
     def __init__(self, config, client):
         self.cfg = config
         self.cli = client
         self.plugins = []
+        self.guard = FloodGuard(config)
+        self.code = CodeCache(config.cache_dir)
+        self.storage = Storage(config.store, config.store_delay)
+        # Held while the plugin list or dispatch tables change, deferred
+        # plugins are added from their loading threads
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.position = {}
+        # Commands addressed to the bot are compiled for this nick
+        self.nick = client.nick
+        self.pool = None
+        if config.workers > 0:
+            self.pool = WorkerPool(config.workers, config.worker_queue,
+                    config.plugin_queue)
+        # Replaced rather than changed so dispatch can read it unlocked
+        self.subscriptions = {}
+        self.sublock = threading.Lock()
+        self.prefixes = []
+        self.commands = {}
+        self.scan = {}
+        self.wildcard = []
+        self.literals = None
+        self.contains = {}
+
+    def load(self, names=None):
+        """\
+        Bring the loaded plugins in line with the plugins directory.
+        A plugin whose file is unchanged (same mtime and size, or failing
+        that the same contents) keeps its state and actions; changed
+        files are reloaded, new ones loaded and deleted ones unloaded.
+        With names only those plugins are looked at, and they're
+        reloaded even if unchanged. Plugins that set `defer = True` are
+        loaded on a thread of their own and join dispatch when ready.
+        Returns the names of the plugins that were loaded and unloaded.
+        """
+        with self.lock:
+            return self.update(names)
+
+    def update(self, names):
+        started = time.time()
+        (hits, misses) = (self.code.hits, self.code.misses)
+        current = dict((p.fname, p) for p in self.plugins)
+        plugins = []
+        (loaded, unloaded, deferred) = ([], [], [])
+        files = list(self.files())
+        self.position = dict((f, i) for (i, f) in enumerate(files))
+        for fname in files:
+            if fname in self.pending:
+                continue
+            old = current.pop(fname, None)
+            if names is not None and self.plugin_name(fname) not in names:
+                if old is not None:
+                    plugins.append(old)
+                continue
+            try:
+                sig = self.fingerprint(fname, old)
+            except (IOError, OSError):
+                log.exception("Error reading: {0}".format(fname))
+                sig = None
+            if old is not None:
+                if names is None and sig is not None and old.signature \
+                        and sig[2] == old.signature[2]:
+                    old.signature = sig
+                    plugins.append(old)
+                    continue
+                if self.reloadable(old, fname):
+                    p = self.reload_plugin(old, fname)
+                    if p is not None:
+                        p.signature = sig
+                        plugins.append(p)
+                        loaded.append(p.name)
+                    else:
+                        unloaded.append(old.name)
+                    continue
+                self.unload_plugin(old)
+                unloaded.append(old.name)
+            if self.deferred(fname):
+                self.defer(fname, sig)
+                deferred.append(self.plugin_name(fname))
+                continue
+            p = self.load_plugin(fname)
+            if p is not None:
+                p.signature = sig
+                plugins.append(p)
+                loaded.append(p.name)
+        # Whatever is left had its file removed
+        for p in current.values():
+            if names is None or p.name in names:
+                self.unload_plugin(p)
+                unloaded.append(p.name)
+            else:
+                plugins.append(p)
+        for fname in self.pending.keys():
+            if fname not in self.position:
+                del self.pending[fname]
+        self.plugins = plugins
+        self.index()
+        if loaded or deferred:
+            log.info("Loaded {0} plugins in {1:.0f}ms ({2} from cache, "
+                    "{3} compiled), {4} deferred".format(len(loaded),
+                    (time.time() - started) * 1000.0,
+                    self.code.hits - hits, self.code.misses - misses,
+                    len(deferred)))
+        return (loaded + deferred, unloaded)
+
+    def deferred(self, fname):
+        try:
+            return declares(fname, "defer")
+        except IOError:
+            return False
+
+    def defer(self, fname, sig):
+        name = "load-{0}".format(self.plugin_name(fname))
+        t = threading.Thread(target=self.finish, args=(fname, sig), name=name)
+        t.setDaemon(True)
+        self.pending[fname] = t
+        t.start()
+
+    def finish(self, fname, sig):
+        p = self.load_plugin(fname)
+        if p is None:
+            with self.lock:
+                if self.pending.get(fname) is threading.current_thread():
+                    del self.pending[fname]
+            return
+        with self.lock:
+            # Unloaded or removed while it was loading
+            current = self.pending.get(fname) is threading.current_thread()
+            if current:
+                del self.pending[fname]
+                p.signature = sig
+                last = len(self.position)
+                order = lambda q: self.position.get(q.fname, last)
+                self.plugins = sorted(self.plugins + [p], key=order)
+                self.index()
+        if not current:
+            self.unload_plugin(p)
+            return
+        log.info("Ready: {0}".format(p.fname))
 
-    def load(self):
-        if len(self.plugins):
-            self.unload()
+    def wait(self):
+        "Wait for deferred plugins to finish loading."
+        for t in self.pending.values():
+            t.join()
+
+    def files(self):
         for dpath, dnames, fnames in os.walk(self.cfg.plugins):
             for fname in fnames:
-                if fname[-3:] != ".py":
-                    continue
-                fname = os.path.join(dpath, fname)
+                if fname[-3:] == ".py":
+                    yield os.path.join(dpath, fname)
+
+    def plugin_name(self, fname):
+        name = os.path.relpath(fname, self.cfg.plugins)
+        return os.path.splitext(name)[0]
+
+    def fingerprint(self, fname, old=None):
+        st = os.stat(fname)
+        if old is not None and old.signature is not None:
+            if old.signature[:2] == (st.st_mtime, st.st_size):
+                return old.signature
+        with open(fname, "rb") as handle:
+            digest = hashlib.sha1(handle.read()).hexdigest()
+        return (st.st_mtime, st.st_size, digest)
+
+    def load_plugin(self, fname):
+        started = time.time()
+        try:
+            if declares(fname, "isolate"):
+                p = PluginHost(self.cfg, self.cli, self, fname)
+            else:
+                p = Plugin(self.cfg, self.cli, self, fname)
+            p.load()
+            log.info("Loaded: {0} ({1:.0f}ms)".format(p.fname,
+                    (time.time() - started) * 1000.0))
+            return p
+        except:
+            log.exception("Error loading: {0}".format(fname))
+            return None
+
+    def reloadable(self, old, fname):
+        "Whether a changed plugin may have a reload hook to hand over to."
+        try:
+            isolated = declares(fname, "isolate")
+            return defines(fname, "reload") \
+                    and isolated == isinstance(old, PluginHost)
+        except IOError:
+            return False
+
+    def reload_plugin(self, old, fname):
+        started = time.time()
+        if self.pool is not None:
+            self.pool.cancel(old)
+        try:
+            # A plugin host reloads in its own process
+            if isinstance(old, PluginHost):
+                p = old
+            else:
                 p = Plugin(self.cfg, self.cli, self, fname)
-                try:
-                    p.load()
-                    log.info("Loaded: {0}".format(p.fname))
-                    self.plugins.append(p)
-                except:
-                    log.exception("Error loading: {0}".format(p.fname))
+            if not p.reload(old):
+                self.unload_plugin(old)
+                old = None
+                p.start()
+            log.info("Reloaded: {0} ({1:.0f}ms)".format(p.fname,
+                    (time.time() - started) * 1000.0))
+            return p
+        except:
+            log.exception("Error loading: {0}".format(fname))
+            if old is not None:
+                self.unload_plugin(old)
+            return None
+
+    def unload_plugin(self, p):
+        if self.pool is not None:
+            self.pool.cancel(p)
+        try:
+            p.unload()
+            log.info("Unloaded: {0}".format(p.fname))
+        except:
+            log.exception("Error unloading: {0}".format(p.fname))
+
+    def index(self):
+        with self.lock:
+            self.build_index()
+
+    def build_index(self):
+        """\
+        Build the dispatch tables for the loaded plugins. Actions are
+        filed by event, with '*' actions kept apart and merged into each
+        event's list, so a line only visits handlers that can fire for
+        it. Commands whose first part is a plain word are further filed
+        under that word so a line only has its prefix stripped once and
+        is then checked against the few commands that could match it.
+        Rules are skipped unless the line contains their required
+        literal, match-all rules always run. Every entry carries its
+        position in plugin and action order so dispatch order doesn't
+        change.
+        """
+        for p in self.plugins:
+            if p.nick != self.nick:
+                p.renick(self.nick)
+        self.prefixes = []
+        for p in Command.prefixes(self.cfg):
+            pattern = p.replace("$nick", re.escape(self.nick))
+            pattern = (pattern + "(\S+)").decode("utf-8")
+            self.prefixes.append(compile_pattern(pattern))
+        self.commands = {}
+        self.scan = {}
+        self.wildcard = []
+        seq = 0
+        for p in self.plugins:
+            for a in p.actions:
+                if a.event == '*':
+                    self.wildcard.append((seq, p, a, None))
+                    seq += 1
+                    continue
+                scan = self.scan.setdefault(a.event, [])
+                if getattr(a, "word", None) is None:
+                    scan.append((seq, p, a, None))
+                else:
+                    words = self.commands.setdefault(a.event, {})
+                    words.setdefault(a.word, []).append((seq, p, a))
+                seq += 1
+        for (event, scan) in self.scan.items():
+            merged = sorted(scan + self.wildcard, key=lambda c: c[0])
+            self.scan[event] = merged
+        # One pass over the text finds every rule literal it contains.
+        # Each position reports the longest literal starting there, so
+        # the literals inside that one are marked present along with it.
+        literals = set()
+        for p in self.plugins:
+            literals.update(a.literal for a in p.actions if a.literal)
+        self.literals = None
+        self.contains = {}
+        if literals:
+            ordered = sorted(literals, key=len, reverse=True)
+            pattern = u"|".join(re.escape(l) for l in ordered)
+            self.literals = re.compile(u"(?=(" + pattern + u"))")
+            for l in literals:
+                self.contains[l] = [m for m in literals if m in l]
+        words = sum(len(c) for w in self.commands.values() for c in w.values())
+        log.debug("Dispatch index: %d by word, %d by literal, %d match all",
+                words, len(literals), len(self.matchall()))
+
+    def candidates(self, msg):
+        scan = self.scan.get(msg.event, self.wildcard)
+        commands = self.commands.get(msg.event)
+        text = msg.text
+        if self.literals is not None:
+            scan = self.prefilter(scan, text)
+        if not text or not commands:
+            return scan
+        found = {}
+        for (i, prefix) in enumerate(self.prefixes):
+            match = prefix.match(text)
+            if not match:
+                continue
+            for (seq, p, a) in commands.get(match.group(1), ()):
+                if seq not in found:
+                    found[seq] = (seq, p, a, [])
+                found[seq][3].append(a.regexps[i])
+        if not found:
+            return scan
+        return sorted(scan + found.values(), key=lambda c: c[0])
+
+    def matchall(self):
+        return [a for p in self.plugins for a in p.actions if a.matchall]
+
+    def prefilter(self, scan, text):
+        "Drop rules whose required literal isn't in the text."
+        present = None
+        keep = []
+        for c in scan:
+            literal = c[2].literal
+            if literal is not None:
+                if present is None:
+                    present = set()
+                    for match in self.literals.finditer(text or u""):
+                        present.update(self.contains[match.group(1)])
+                if literal not in present:
+                    continue
+            keep.append(c)
+        return keep
 
     def unload(self):
-        while len(self.plugins):
-            p = self.plugins.pop(0)
-            try:
-                p.unload()
-                log.info("Unloaded: {0}".format(p.fname))
-            except:
-                log.exception("Error unloading: {0}".format(p.fname))
+        with self.lock:
+            self.pending.clear()
+            while len(self.plugins):
+                self.unload_plugin(self.plugins.pop(0))
+            self.index()
 
     def handle(self, msg):
+        if not self.guard.allow(msg):
+            self.cli.recorder.record("DENY", msg.source)
+            return
+        if self.cli.nick != self.nick:
+            self.renick()
+        with self.lock:
+            candidates = self.candidates(msg)
         try:
-            for p in self.plugins:
-                p.handle(msg)
+            for (_, p, a, regexps) in candidates:
+                p.run(a, msg, regexps)
+            if self.subscriptions:
+                self.route(msg)
         except StopIteration:
             pass
 
+    def renick(self):
+        with self.lock:
+            self.nick = self.cli.nick
+            self.build_index()
+        log.info("Commands now answer to {0}".format(self.nick))
+
+    def route(self, msg):
+        "Pass a message to the subscriptions waiting for it."
+        if msg.event != u"PRIVMSG" or not msg.target:
+            return
+        nick = (msg.nick or u"").lower()
+        if msg.target == self.cli.nick:
+            keys = [("private", nick), ("private", "*")]
+        else:
+            keys = [("channel", msg.target.lower())]
+        keys.append(("reply", nick))
+        for key in keys:
+            for sub in self.subscriptions.get(key, ()):
+                # Not the line that led to the subscription
+                if msg.received >= sub.created:
+                    sub.owner.plugin.deliver(sub, msg)
+
+    def subscribe(self, sub):
+        with self.sublock:
+            subs = dict(self.subscriptions)
+            for key in sub.keys:
+                subs[key] = subs.get(key, []) + [sub]
+            self.subscriptions = subs
+
+    def unsubscribe(self, sub):
+        with self.sublock:
+            subs = dict(self.subscriptions)
+            for key in sub.keys:
+                kept = [s for s in subs.get(key, []) if s is not sub]
+                if kept:
+                    subs[key] = kept
+                else:
+                    subs.pop(key, None)
+            self.subscriptions = subs
+
+
+class LineBuffer(object):
+    """\
+    Receive buffer that frames newline terminated lines. Data is read
+    straight into a preallocated bytearray and every complete line is
+    sliced out of it in a single pass. The trailing partial line stays
+    where it is until the free space runs out and is then moved to the
+    front of the same buffer.
+    """
+
+    def __init__(self, size=8192, limit=65536):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.limit = limit
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def recv_into(self, sock):
+        if self.end == len(self.buf):
+            self.reserve()
+        size = len(self.buf) - self.end
+        count = sock.recv_into(self.view[self.end:], size)
+        self.end += count
+        return count
+
+    def tail(self):
+        "The bytes of the incomplete line received so far."
+        return self.view[self.start:self.end].tobytes()
+
+    def feed(self, data):
+        while len(self.buf) - self.end < len(data):
+            self.reserve()
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def lines(self):
+        buf = self.buf
+        view = self.view
+        pos = self.start
+        end = self.end
+        ret = []
+        while True:
+            idx = buf.find(b"\n", pos, end)
+            if idx < 0:
+                break
+            stop = idx
+            if stop > pos and buf[stop - 1] == 13:
+                stop -= 1
+            ret.append(view[pos:stop].tobytes())
+            pos = idx + 1
+        if pos == end:
+            self.start = self.end = 0
+        else:
+            self.start = pos
+        return ret
+
+    def reserve(self):
+        if self.start > 0:
+            tail = self.end - self.start
+            self.buf[:tail] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = tail
+        elif len(self.buf) < self.limit:
+            # A bytearray can't be resized while a memoryview exists
+            # so grow into a new buffer.
+            grown = bytearray(min(self.limit, len(self.buf) * 2))
+            grown[:self.end] = self.view[:self.end]
+            self.buf = grown
+            self.view = memoryview(self.buf)
+        else:
+            log.warning("Discarding unterminated line of %d bytes", self.end)
+            self.start = self.end = 0
+
+
+def decode(line):
+    # Most traffic is plain ASCII which decodes without a fallback.
+    try:
+        return line.decode("ascii")
+    except UnicodeDecodeError:
+        pass
+    try:
+        return line.decode("utf-8")
+    except UnicodeDecodeError:
+        return line.decode("iso-8859-1")
+
+
+class Inbox(object):
+    """\
+    Bounded queue of received messages. Once more than shed_size
+    messages are waiting, JOIN/PART/QUIT style noise is dropped on
+    arrival, and once size are waiting everything else is dropped too
+    except PINGs, numerics, ERRORs and anything about our own nick,
+    which the connection itself depends on.
+    """
+
+    def __init__(self, client):
+        cfg = client.cfg
+        self.client = client
+        self.size = cfg.inbound_queue_size
+        self.shed_size = cfg.inbound_shed_size
+        self.shed_events = frozenset(cfg.inbound_shed_events)
+        self.cond = threading.Condition()
+        self.q = collections.deque()
+        self.dropped = collections.defaultdict(int)
+        self.last_report = time.time()
+
+    def __len__(self):
+        return len(self.q)
+
+    def essential(self, msg):
+        event = msg.event
+        if event in (u"PING", u"ERROR") or (event and event.isdigit()):
+            return True
+        return msg.nick == self.client.nick
+
+    def put(self, msg):
+        with self.cond:
+            depth = len(self.q)
+            if depth >= self.shed_size and not self.essential(msg):
+                if depth >= self.size or msg.event in self.shed_events:
+                    self.drop(msg)
+                    return
+            self.q.append(msg)
+            self.cond.notify()
+
+    def drop(self, msg):
+        self.client.recorder.record("SHED", msg.raw)
+        self.dropped[msg.event] += 1
+        now = time.time()
+        if now - self.last_report >= 10.0:
+            self.last_report = now
+            counts = ", ".join("{0}={1}".format(*kv)
+                    for kv in sorted(self.dropped.items()))
+            log.warning("Inbound queue overloaded, dropped: {0}".format(
+                    counts))
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if block:
+                deadline = None
+                if timeout is not None:
+                    deadline = time.time() + timeout
+                while not self.q:
+                    wait = None
+                    if deadline is not None:
+                        wait = deadline - time.time()
+                        if wait <= 0:
+                            break
+                    self.cond.wait(wait)
+            if not self.q:
+                raise Queue.Empty()
+            return self.q.popleft()
+
+    def get_nowait(self):
+        return self.get(False)
+
 
 class Reader(object):
-    def __init__(self, client, sock):
+    def __init__(self, client, sock, threaded=True):
         self.client = client
         self.sock = sock
-        self.buf = StringIO.StringIO()
-        self.q = Queue.Queue()
+        self.buf = LineBuffer()
+        self.q = Inbox(client)
+        self.closed = False
+        self.t = None
+        if threaded:
+            self.start()
+
+    def start(self):
         self.t = threading.Thread(target=self.run, args=tuple())
         self.t.setDaemon(True)
         self.t.start()
 
     def is_alive(self):
-        return self.t.is_alive()
+        return self.t is None or self.t.is_alive()
 
     def next(self, timeout=None):
         return self.q.get(True, timeout)
 
+    def close(self):
+        self.closed = True
+
     def run(self):
-        while True:
+        # Wakes up now and then so close() stops it without touching the
+        # socket, which handoff() passes on to another process
+        while not self.closed:
             try:
-                self.recv()
+                if self.ready(0.5):
+                    self.recv()
+            except socket.error, e:
+                if not self.closed:
+                    log.error("Error receiving data: {0}".format(e))
+                return
             except:
                 log.exception("Error receiving data")
                 return
 
+    def ready(self, timeout):
+        # SSL may hold decrypted bytes that select() can't see
+        pending = getattr(self.sock, "pending", None)
+        if pending is not None and pending() > 0:
+            return True
+        (rlist, _, _) = select.select([self.sock], [], [], timeout)
+        return bool(rlist)
+
     def recv(self):
-        data = self.sock.recv(4096)
-        while data.find("\n") > 0:
-            (msg, data) = data.split("\n", 1)
-            self.handle(msg)
-        self.buf.write(data)
+        if not self.buf.recv_into(self.sock):
+            raise socket.error("Connection closed by server")
+        # Stamped on arrival, dispatch can be a long way behind
+        self.client.last_recv = time.time()
+        for line in self.buf.lines():
+            if line:
+                self.handle(line)
 
     def handle(self, msg):
-        log.log(TRACE, "RECV: %r" % msg)
-        if self.buf.tell() > 0:
-            self.buf.write(msg)
-            msg = self.buf.getvalue()
-            self.buf = StringIO.StringIO()
-        msg = msg.rstrip("\r")
+        log.log(TRACE, "RECV: %r", msg)
+        self.client.recorder.record("RECV", msg)
         try:
             msg = self.parse(msg)
         except:
-            log.exception(u"Error parsing line: %s" % msg)
+            log.exception(u"Error parsing line: %r" % msg)
         log.log(TRACE, msg)
         self.q.put(msg)
 
     def parse(self, line):
-        decoded = False
-        for enc in ("utf-8", "iso-8859-1"):
-            try:
-                line = line.decode(enc)
-                decoded = True
-                break
-            except UnicodeDecodeError:
-                pass
-        if not decoded:
-            line = line.decode("utf-8", "replace")
-        return Message(self.client, line)
+        return Message(self.client, decode(line))
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def refill(self, now):
+        elapsed = max(0.0, now - self.stamp)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.stamp = now
+
+    def delay(self, needed, now):
+        "Seconds until the bucket holds at least needed tokens."
+        self.refill(now)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, cost):
+        self.tokens -= cost
+
+
+class OutputQueue(object):
+    """\
+    Outbound messages sorted into priority lanes and released against a
+    shared token bucket. Protocol traffic (PONG, NICK, JOIN, ...) goes
+    out ahead of anything waiting in the chat lane and only waits while
+    the bucket is overdrawn. Chat traffic waits until the bucket can pay
+    for the whole line, so it only ever spends what protocol traffic
+    left behind.
+
+    The chat lane keeps a queue per recipient and serves them round
+    robin so a long burst to one channel or user can't hold up replies
+    everywhere else.
+    """
+
+    PROTOCOL = 0
+    CHAT = 1
+
+    CHAT_COMMANDS = frozenset(["PRIVMSG", "NOTICE"])
+
+    def __init__(self, bucket):
+        self.cond = threading.Condition()
+        self.protocol = collections.deque()
+        self.chat = {}
+        self.rotation = collections.deque()
+        self.bucket = bucket
+        self.paused = False
+        self.closed = False
+
+    def __len__(self):
+        with self.cond:
+            return len(self.protocol) + sum(map(len, self.chat.values()))
+
+    def lane(self, command):
+        if command.upper() in self.CHAT_COMMANDS:
+            return self.CHAT
+        return self.PROTOCOL
+
+    def cost(self, msg):
+        # Longer lines cost more, in seconds of sustained send rate.
+        penalty = float(max(0, len(msg) - 50)) / 70.0
+        return min(3.0, 0.4 + penalty)
+
+    def put(self, msg, lane, target=None):
+        with self.cond:
+            if lane == self.PROTOCOL:
+                self.protocol.append(msg)
+            else:
+                key = (target or u"").lower()
+                if key not in self.chat:
+                    self.chat[key] = collections.deque()
+                    self.rotation.append(key)
+                self.chat[key].append((time.time(), msg))
+            self.cond.notify()
+
+    def pause(self):
+        "Hold chat lines until resume(), protocol lines keep flowing."
+        with self.cond:
+            self.paused = True
+
+    def resume(self):
+        with self.cond:
+            self.paused = False
+            self.cond.notify()
+
+    def close(self):
+        "Wake any waiting get() which then returns None."
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def adopt(self, other):
+        "Take over the chat lines still queued in other."
+        with other.cond:
+            (chat, rotation) = (other.chat, other.rotation)
+            other.chat = {}
+            other.rotation = collections.deque()
+        with self.cond:
+            for key in rotation:
+                if key in self.chat:
+                    self.chat[key].extend(chat[key])
+                else:
+                    self.chat[key] = chat[key]
+                    self.rotation.append(key)
+            self.cond.notify()
+
+    def dump(self):
+        "Return every queued line as JSON friendly data, in send order."
+        with self.cond:
+            chat = []
+            for key in self.rotation:
+                lines = [m.decode("iso-8859-1") for (_, m) in self.chat[key]]
+                chat.append((key, lines))
+            return {
+                "protocol": [m.decode("iso-8859-1") for m in self.protocol],
+                "chat": chat
+            }
+
+    def restore(self, data):
+        for msg in data["protocol"]:
+            self.put(msg.encode("iso-8859-1"), self.PROTOCOL)
+        for (key, lines) in data["chat"]:
+            for msg in lines:
+                self.put(msg.encode("iso-8859-1"), self.CHAT, key)
+
+    def stats(self):
+        "Return {target: (queued lines, seconds the oldest has waited)}"
+        now = time.time()
+        with self.cond:
+            return dict(
+                (k, (len(q), now - q[0][0])) for (k, q) in self.chat.items()
+            )
+
+    def poll(self):
+        """\
+        Remove and return (msg, 0.0) if a message may be sent now.
+        Otherwise return (None, wait) where wait is the number of
+        seconds until one can be sent or None if nothing is queued.
+        """
+        with self.cond:
+            return self._poll(time.time())
+
+    def get(self):
+        with self.cond:
+            while not self.closed:
+                (msg, wait) = self._poll(time.time())
+                if msg is not None:
+                    return msg
+                self.cond.wait(wait)
+            return None
+
+    def _poll(self, now):
+        if self.protocol:
+            wait = self.bucket.delay(0.0, now)
+            if wait > 0:
+                return (None, wait)
+            msg = self.protocol.popleft()
+        elif self.rotation and not self.paused:
+            key = self.rotation[0]
+            queue = self.chat[key]
+            wait = self.bucket.delay(self.cost(queue[0][1]), now)
+            if wait > 0:
+                return (None, wait)
+            msg = queue.popleft()[1]
+            self.rotation.popleft()
+            if queue:
+                self.rotation.append(key)
+            else:
+                del self.chat[key]
+        else:
+            return (None, None)
+        self.bucket.take(self.cost(msg))
+        return (msg, 0.0)
+
+
+class RateController(object):
+    """\
+    Tunes the send rate of the output token bucket from what the link
+    tells us. A PING is sent every probe_interval seconds and its round
+    trip is measured: if it comes back quickly while chat was waiting
+    the rate is raised a step, if it's slow the rate is cut. Throttle
+    replies from the server (ERR_TARGETTOOFAST, RPL_TRYAGAIN, flood
+    notices and "Excess Flood" disconnects) halve the rate and empty
+    the bucket immediately.
+    """
+
+    PROBE_PREFIX = u"gizzy-lag-"
+    THROTTLE_EVENTS = frozenset([u"263", u"439"])
+    THROTTLE_RE = re.compile(r"(?i)(excess flood|throttl|flooding|too fast)")
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.bucket = TokenBucket(profile["rate"], profile["burst"])
+        self.lag = None
+        self.probe_token = None
+        self.probe_sent = 0.0
+        self.probe_backlog = 0
+        self.last_probe = time.time()
+
+    def probe(self, backlog):
+        "Return a PING token if a lag probe is due, otherwise None."
+        now = time.time()
+        if now - self.last_probe < self.profile["probe_interval"]:
+            return None
+        self.last_probe = now
+        self.probe_sent = now
+        self.probe_backlog = backlog
+        self.probe_token = u"{0}{1:.3f}".format(self.PROBE_PREFIX, now)
+        return self.probe_token
+
+    def observe(self, msg):
+        if msg.event == u"PONG":
+            token = msg.text or (msg.args[-1] if msg.args else None)
+            if token and token == self.probe_token:
+                self.probe_token = None
+                self.pong(time.time() - self.probe_sent)
+        elif msg.event in self.THROTTLE_EVENTS:
+            self.throttled(msg)
+        elif msg.event in (u"NOTICE", u"ERROR") and msg.user in (None, u""):
+            # Only server notices, never anything a user said.
+            if self.THROTTLE_RE.search(msg.text):
+                self.throttled(msg)
+
+    def pong(self, lag):
+        self.lag = lag
+        rate = self.bucket.rate
+        if lag > self.profile["max_lag"]:
+            self.set_rate(rate * 0.75)
+        elif self.probe_backlog:
+            self.set_rate(rate + self.profile["min_rate"])
+        log.debug("Lag: %.3fs, send rate: %.2f", lag, self.bucket.rate)
+
+    def throttled(self, msg):
+        log.warning("Server throttled output: %s", msg.raw)
+        self.set_rate(self.bucket.rate * 0.5)
+        self.bucket.tokens = min(self.bucket.tokens, 0.0)
+
+    def set_rate(self, rate):
+        low = self.profile["min_rate"]
+        high = self.profile["max_rate"]
+        self.bucket.rate = max(low, min(high, rate))
 
 
 class Writer(object):
-    def __init__(self, client, sock):
+    def __init__(self, client, sock, threaded=True):
         self.client = client
         self.sock = sock
-        self.sent = []
-        self.q = Queue.Queue()
-        self.t = threading.Thread(target=self.run, args=tuple())
-        self.t.setDaemon(True)
-        self.t.start()
+        self.sent = collections.deque()
+        self.counts = collections.defaultdict(int)
+        self.q = OutputQueue(client.rate.bucket)
+        self.wakeup = None
+        self.t = None
+        if threaded:
+            self.t = threading.Thread(target=self.run, args=tuple())
+            self.t.setDaemon(True)
+            self.t.start()
 
     def is_alive(self):
-        return self.t.is_alive()
+        return self.t is None or self.t.is_alive()
+
+    def close(self):
+        self.q.close()
 
     def action(self, recip, text):
         msg = "\001ACTION {0}\001".format(text)
@@ -449,54 +2546,60 @@ class Writer(object):
     def notice(self, recip, text):
         self.write(('NOTICE', recip), text)
 
-    def write(self, args, text=None):
+    def write(self, args, text=None, lane=None):
         msg = u" ".join(self.fmt(a) for a in args)
         if text is not None:
             msg += u" :" + self.fmt(text)
         msg = msg[:510] + u"\r\n"
-        self.q.put(msg)
+        target = args[1] if len(args) > 1 else None
+        if lane is None:
+            lane = self.q.lane(args[0])
+        self.q.put(self.prepare(msg), lane, target)
+        if self.wakeup is not None:
+            self.wakeup()
 
     def run(self):
-        while True:
-            try:
-                self.send()
-            except:
-                log.exception("Error sending message")
-                return
+        try:
+            while self.send():
+                pass
+        except:
+            log.exception("Error sending message")
 
     def send(self):
         msg = self.q.get()
+        if msg is None:
+            return False
+        self.transmit(msg)
+        return True
+
+    def prepare(self, msg):
         assert isinstance(msg, unicode), ("Invalid unicode message", msg)
-        msg = msg.encode("utf-8")
-        log.log(TRACE, "SEND: %r" % msg)
-        self.rate_limit(msg)
+        return msg.encode("utf-8")
+
+    def transmit(self, msg):
+        log.log(TRACE, "SEND: %r", msg)
         if self.is_looping(msg):
-            log.log(TRACE, "DROP: %r" % msg)
+            log.log(TRACE, "DROP: %r", msg)
+            self.client.recorder.record("DROP", msg)
             return
+        self.client.recorder.record("SEND", msg)
         self.sent.append((time.time(), msg))
-        self.sent = self.sent[-10:]
+        self.counts[msg] += 1
         self.sock.sendall(msg)
 
-    def rate_limit(self, msg):
-        if not self.sent:
-            return
-        penalty = float(max(0, len(msg) - 50)) / 70.0
-        wait = min(3.0, 0.4 + penalty)
-        elapsed = time.time() - self.sent[-1][0]
-        if elapsed < wait:
-            log.log(TRACE, "SLEEP: %f" % (wait - elapsed))
-            time.sleep(wait - elapsed)
-
     def is_looping(self, new_msg):
-        count = 0
-        for (when, old_msg) in reversed(self.sent):
-            if time.time() - when > 5.0:
-                return False
-            if new_msg == old_msg:
-                count += 1
-            if count >= 3:
-                return True
-        return False
+        # Drop a line if it was already sent three times within the
+        # last ten lines and five seconds.
+        now = time.time()
+        while self.sent:
+            (when, old_msg) = self.sent[0]
+            if len(self.sent) <= 10 and now - when <= 5.0:
+                break
+            self.sent.popleft()
+            self.counts[old_msg] -= 1
+            if not self.counts[old_msg]:
+                del self.counts[old_msg]
+        return self.counts.get(new_msg, 0) >= 3
 
     def fmt(self, data):
         if not isinstance(data, unicode):
@@ -506,61 +2609,532 @@ class Writer(object):
         return data
 
 
+class EventLoop(object):
+    """\
+    Single threaded transport. Socket reads, line framing and rate
+    limited writes are multiplexed with select() on the thread that
+    dispatches messages, so a parsed line reaches the plugins without
+    passing through another thread. Writes queued from other threads
+    (timers, HTTP events) wake the loop through a self-pipe.
+    """
+
+    def __init__(self, client, sock):
+        self.client = client
+        self.sock = sock
+        self.reader = Reader(client, sock, threaded=False)
+        self.writer = Writer(client, sock, threaded=False)
+        self.writer.wakeup = self.wakeup
+        self.alive = True
+        (self.rfd, self.wfd) = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def is_alive(self):
+        return self.alive
+
+    def close(self):
+        self.alive = False
+        # The descriptors may be reused as soon as they're closed so make
+        # sure nothing can write to them afterwards.
+        self.writer.wakeup = None
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+    def wakeup(self):
+        try:
+            os.write(self.wfd, "\0")
+        except OSError:
+            # The pipe is full so the loop is already awake.
+            pass
+
+    def next(self, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.alive:
+            # Replies to the last message (a PONG say) shouldn't wait for
+            # the rest of the batch to be dispatched
+            self.flush()
+            try:
+                return self.reader.q.get_nowait()
+            except Queue.Empty:
+                pass
+            if not self.step(deadline):
+                break
+        raise Queue.Empty()
+
+    def step(self, deadline):
+        wait = self.flush()
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if wait is None or remaining < wait:
+                wait = remaining
+        try:
+            self.poll(wait)
+        except socket.error, e:
+            log.error("Error in event loop: {0}".format(e))
+            self.alive = False
+            return False
+        except:
+            log.exception("Error in event loop")
+            self.alive = False
+            return False
+        return True
+
+    def flush(self):
+        "Send every write that is due, return the wait until the next one."
+        while True:
+            (msg, wait) = self.writer.q.poll()
+            if msg is None:
+                return wait
+            self.writer.transmit(msg)
+
+    def poll(self, timeout):
+        (rlist, _, _) = select.select([self.sock, self.rfd], [], [], timeout)
+        if self.rfd in rlist:
+            try:
+                while os.read(self.rfd, 4096):
+                    pass
+            except OSError:
+                pass
+        if self.sock in rlist:
+            self.reader.recv()
+            # SSL may hold decrypted bytes that select() can't see
+            pending = getattr(self.sock, "pending", None)
+            while pending is not None and pending() > 0:
+                self.reader.recv()
+
+
+class Registration(object):
+    """\
+    Connection registration driven by server replies rather than fixed
+    sleeps. After NICK and USER we wait for the end of the MOTD, which
+    follows 001 and the ISUPPORT (005) lines, then identify with
+    NickServ if configured and wait for it to confirm. Channels are
+    joined as soon as that's done, packed into as few JOIN lines as the
+    advertised TARGMAX and the line length allow. Nick collisions during
+    registration move on to the configured alt_nicks.
+    """
+
+    NICK_ERRORS = frozenset([u"431", u"432", u"433", u"436", u"437"])
+    MOTD_DONE = frozenset([u"376", u"422"])
+    IDENTIFIED_RE = re.compile(
+            r"(?i)(you are now (identified|logged in)|password accepted)")
+
+    def __init__(self, client):
+        self.client = client
+        self.cfg = client.cfg
+        self.state = "connecting"
+        self.deadline = None
+        self.nicks = list(self.cfg.alt_nicks)
+        self.isupport = {}
+
+    def start(self):
+        if self.cfg.serverpass is not None:
+            self.client.write(('PASS', self.cfg.serverpass))
+        self.client.nick = self.cfg.nick
+        self.client.write(('NICK', self.cfg.nick))
+        self.client.write(
+                ('USER', self.cfg.user, '+iw', self.cfg.nick), self.cfg.name)
+
+    def resume(self, state):
+        "Carry on with a connection registered by a previous process."
+        self.state = "ready"
+        self.isupport = state["isupport"]
+        self.client.nick = state["nick"]
+        self.client.channels.update(state["channels"])
+        # Restarting picks up a new config, join anything added to it
+        added = [c for c in self.cfg.channels
+                if c[0].lower() not in self.client.channels]
+        for args in self.join_lines(added):
+            self.client.write(args)
+
+    def tick(self):
+        if self.deadline is None or time.time() < self.deadline:
+            return
+        if self.state == "welcomed":
+            log.warning("No end of MOTD received, continuing")
+            self.registered()
+        elif self.state == "identifying":
+            log.warning("No NickServ confirmation, joining anyway")
+            self.join()
+
+    def handle(self, msg):
+        event = msg.event
+        if event == u"001":
+            self.client.nick = msg.target
+            self.state = "welcomed"
+            self.deadline = time.time() + self.cfg.register_timeout
+            log.info("Registered as {0}".format(msg.target))
+        elif event == u"005":
+            self.parse_isupport(msg.args)
+        elif event in self.MOTD_DONE and self.state == "welcomed":
+            self.registered()
+        elif event in self.NICK_ERRORS and self.state == "connecting":
+            self.next_nick()
+        elif event == u"NICK" and msg.nick == self.client.nick:
+            self.client.nick = msg.text or msg.target
+        elif event == u"JOIN" and msg.nick == self.client.nick:
+            self.client.channels.add((msg.target or msg.text).lower())
+        elif event == u"PART" and msg.nick == self.client.nick:
+            self.client.channels.discard(msg.target.lower())
+        elif event == u"KICK" and msg.args[:1] == [self.client.nick]:
+            self.client.channels.discard(msg.target.lower())
+        elif self.state == "identifying" and self.identified(msg):
+            log.info("Identified with NickServ")
+            self.join()
+
+    def next_nick(self):
+        if self.nicks:
+            nick = self.nicks.pop(0)
+        else:
+            nick = self.client.nick + "_"
+        log.warning("Nick {0} unavailable, trying {1}".format(
+                self.client.nick, nick))
+        self.client.nick = nick
+        self.client.write(('NICK', nick))
+
+    def registered(self):
+        if not self.cfg.nickpass:
+            self.join()
+            return
+        self.state = "identifying"
+        self.deadline = time.time() + self.cfg.identify_timeout
+        # Chat is paused until we've joined, which waits on this
+        self.client.write(('PRIVMSG', 'NickServ'),
+                'IDENTIFY {0}'.format(self.cfg.nickpass),
+                lane=OutputQueue.PROTOCOL)
+
+    def identified(self, msg):
+        if msg.event == u"900":
+            return True
+        if msg.event != u"NOTICE" or (msg.nick or "").lower() != "nickserv":
+            return False
+        return self.IDENTIFIED_RE.search(msg.text) is not None
+
+    def join(self):
+        self.state = "ready"
+        self.deadline = None
+        for args in self.join_lines(self.cfg.channels):
+            self.client.write(args)
+        self.client.writer.q.resume()
+
+    def join_lines(self, channels):
+        # Keys are positional so keyed channels have to come first.
+        keyed = [c for c in channels if c[1] is not None]
+        ordered = keyed + [c for c in channels if c[1] is None]
+        limit = self.isupport.get("TARGMAX", {}).get("JOIN")
+        names = []
+        keys = []
+        for (name, key) in ordered:
+            more_names = names + [name]
+            more_keys = keys + ([key] if key is not None else [])
+            size = len("JOIN ") + len(",".join(more_names))
+            if more_keys:
+                size += 1 + len(",".join(more_keys))
+            full = (limit and len(more_names) > limit) or size > 510
+            if names and full:
+                yield self.join_args(names, keys)
+                more_names = [name]
+                more_keys = [key] if key is not None else []
+            (names, keys) = (more_names, more_keys)
+        if names:
+            yield self.join_args(names, keys)
+
+    def join_args(self, names, keys):
+        if keys:
+            return ('JOIN', ",".join(names), ",".join(keys))
+        return ('JOIN', ",".join(names))
+
+    def parse_isupport(self, tokens):
+        for token in tokens:
+            if token[:1] == "-":
+                self.isupport.pop(token[1:], None)
+                continue
+            (name, _, value) = token.partition("=")
+            if name == "TARGMAX":
+                targets = {}
+                for item in value.split(","):
+                    (cmd, _, count) = item.partition(":")
+                    targets[cmd] = int(count) if count else None
+                self.isupport[name] = targets
+            else:
+                self.isupport[name] = value
+
+
+def connect_any(host, port, timeout=30.0, stagger=0.25):
+    """\
+    Connect to every address host resolves to, starting a new attempt
+    every stagger seconds while earlier ones are still pending and
+    alternating address families (RFC 8305). The first connection to
+    complete is returned and the others are abandoned.
+    """
+    infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+            socket.SOCK_STREAM)
+    families = collections.OrderedDict()
+    for info in infos:
+        families.setdefault(info[0], []).append(info)
+    addrs = []
+    while any(families.values()):
+        for family in families.values():
+            if family:
+                addrs.append(family.pop(0))
+
+    pending = {}
+    errors = []
+    winner = None
+    deadline = time.time() + timeout
+    start_next = time.time()
+    try:
+        while winner is None and (addrs or pending):
+            now = time.time()
+            if now >= deadline:
+                errors.append("timed out")
+                break
+            if addrs and (now >= start_next or not pending):
+                (family, socktype, proto, _, addr) = addrs.pop(0)
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(0)
+                err = sock.connect_ex(addr)
+                if err == 0:
+                    winner = sock
+                elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    pending[sock] = addr
+                    start_next = now + stagger
+                else:
+                    errors.append("{0}: {1}".format(addr, os.strerror(err)))
+                    sock.close()
+                continue
+            wait = deadline - now
+            if addrs:
+                wait = max(0.0, min(wait, start_next - now))
+            (_, ready, _) = select.select([], pending.keys(), [], wait)
+            for sock in ready:
+                addr = pending.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    winner = sock
+                    break
+                errors.append("{0}: {1}".format(addr, os.strerror(err)))
+                sock.close()
+    finally:
+        for sock in pending:
+            sock.close()
+    if winner is None:
+        msg = "Unable to connect to {0}:{1}: {2}"
+        raise socket.error(msg.format(host, port, "; ".join(errors)))
+    winner.setblocking(1)
+    return winner
+
+
+def set_keepalive(sock, idle=60, interval=15, count=4):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    options = (
+        ("TCP_KEEPIDLE", idle),
+        ("TCP_KEEPINTVL", interval),
+        ("TCP_KEEPCNT", count)
+    )
+    for (name, value) in options:
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+
+class Backoff(object):
+    "Exponential reconnect delays with full jitter."
+
+    def __init__(self, base, cap):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.cap, self.base * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(0, delay)
+
+    def reset(self):
+        self.attempts = 0
+
+
 class Client(object):
     def __init__(self, cfg):
         self.cfg = cfg
         self.sock = None
         self.reader = None
         self.writer = None
+        self.loop = None
+        self.rate = RateController(cfg.rate_profile)
+        self.registration = None
+        self.nick = cfg.nick
+        self.tls = None
+        self.connected_at = None
+        self.last_recv = None
+        self.channels = set()
+        self.inbound_lag = 0.0
+        self.lag_warned = 0.0
+        self.recorder = FlightRecorder(cfg.trace_buffer, cfg.trace_sample)
+
+    @property
+    def isupport(self):
+        "ISUPPORT (005) tokens advertised by the server."
+        if self.registration is None:
+            return {}
+        return self.registration.isupport
 
     def connect(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock = connect_any(self.cfg.host, self.cfg.port,
+                self.cfg.connect_timeout)
+        set_keepalive(self.sock)
         if self.cfg.use_ssl:
-            self.sock = ssl.wrap_socket(self.sock)
-        self.sock.connect((self.cfg.host, self.cfg.port))
-        self.reader = Reader(self, self.sock)
-        self.writer = Writer(self, self.sock)
-
-        if self.cfg.serverpass is not None:
-            self.write(('PASS', self.cfg.serverpass))
-        self.write(('NICK', self.cfg.nick))
-        self.write(('USER', self.cfg.user, '+iw', self.cfg.nick), self.cfg.name)
-
-        if self.cfg.nickpass:
-            self.msg('NickServ', 'IDENTIFY {0}'.format(self.cfg.nickpass))
-            time.sleep(5)
+            # One context for the life of the process, certificates are
+            # not verified, same as the previous ssl.wrap_socket() call.
+            if self.tls is None:
+                self.tls = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.sock = self.tls.wrap_socket(self.sock,
+                    server_hostname=self.cfg.host)
+        log.info("Connected to {0}".format(self.sock.getpeername()))
+        self.attach(self.sock)
+        # Chat is held until we've rejoined, including anything left
+        # over from the previous connection.
+        self.writer.q.pause()
+        self.registration = Registration(self)
+        self.registration.start()
+
+    def resume(self, state):
+        "Take over a connection handed off by handoff() in another process."
+        sock = socket.fromfd(state["fd"], state["family"], socket.SOCK_STREAM)
+        os.close(state["fd"])
+        log.info("Resumed connection to {0}".format(sock.getpeername()))
+        # Nothing may be read from the socket until what the previous
+        # process had already read is back in front of it
+        self.attach(sock, start=False)
+        reader = self.inbox()
+        reader.buf.feed(state["partial"].encode("iso-8859-1"))
+        for raw in state["inbox"]:
+            reader.q.put(Message(self, raw))
+        self.registration = Registration(self)
+        self.registration.resume(state)
+        (self.rate.bucket.rate, self.rate.bucket.tokens) = state["rate"]
+        self.writer.q.restore(state["output"])
+        if self.loop is None:
+            reader.start()
+
+    def attach(self, sock, start=True):
+        self.sock = sock
+        self.connected_at = self.last_recv = time.time()
+        self.channels = set()
+        previous = self.writer
+        if self.cfg.transport == "loop":
+            self.loop = EventLoop(self, self.sock)
+            self.reader = self.loop
+            self.writer = self.loop.writer
+        else:
+            self.loop = None
+            self.reader = Reader(self, self.sock, threaded=start)
+            self.writer = Writer(self, self.sock)
+        if previous is not None:
+            self.writer.q.adopt(previous.q)
+
+    def inbox(self):
+        "The Reader that frames and queues inbound lines."
+        if self.loop is not None:
+            return self.loop.reader
+        return self.reader
+
+    def handoff(self):
+        """\
+        Stop using the connection and return what a new process needs to
+        carry on with it: the socket's descriptor, registration state,
+        unsent output and unprocessed input. Returns None when the
+        connection can't be handed over because its TLS state only
+        exists inside this process.
+        """
+        if self.cfg.use_ssl:
+            return None
+        self.reader.close()
+        self.writer.close()
+        if self.writer.t is not None:
+            self.writer.t.join(1.0)
+        reader = self.inbox()
+        # Lines the reader takes after the inbox is drained would be lost
+        if reader.t is not None:
+            reader.t.join(5.0)
+            if reader.t.is_alive():
+                return None
+        inbox = []
+        while True:
+            try:
+                inbox.append(reader.q.get_nowait().raw)
+            except Queue.Empty:
+                break
+        fd = self.sock.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        return {
+            "fd": fd,
+            "family": self.sock.family,
+            "nick": self.nick,
+            "channels": sorted(self.channels),
+            "isupport": self.isupport,
+            "rate": (self.rate.bucket.rate, self.rate.bucket.tokens),
+            "output": self.writer.q.dump(),
+            "inbox": inbox,
+            "partial": reader.buf.tail().decode("iso-8859-1")
+        }
 
-        # drain the queue to deal with potential PONG request
+    def close(self):
+        self.reader.close()
+        self.writer.close()
         try:
-            for msg in self.messages(drain=True):
-                continue
-        except Queue.Empty:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
             pass
+        self.sock.close()
 
-        for (chname, pwd) in self.cfg.channels:
-            if pwd is not None:
-                self.write(('JOIN', chname, pwd))
-            else:
-                self.write(('JOIN', chname))
-            time.sleep(0.5)
-
-    def messages(self, drain=False):
+    def messages(self):
         while True:
             if not self.reader.is_alive():
                 return
             if not self.writer.is_alive():
                 return
+            self.registration.tick()
+            probe = self.rate.probe(len(self.writer.q))
+            if probe is not None:
+                self.writer.write(("PING", probe))
             try:
                 msg = self.reader.next(timeout=2)
-                msg.client = self
-                if msg.event == u"PING":
-                    self.writer.write(("PONG", msg.text))
-                yield msg
             except Queue.Empty:
-                if drain:
-                   raise
-                else:
-                    continue
+                # Only once the backlog is gone, falling behind on
+                # dispatch doesn't mean the server went quiet
+                if time.time() - self.last_recv > self.cfg.ping_timeout:
+                    log.warning("No data from server in {0}s".format(
+                            self.cfg.ping_timeout))
+                    return
+                continue
+            self.check_lag(msg)
+            msg.client = self
+            if msg.event == u"PING":
+                self.writer.write(("PONG", msg.text))
+            self.registration.handle(msg)
+            self.rate.observe(msg)
+            yield msg
+
+    def check_lag(self, msg):
+        now = time.time()
+        self.inbound_lag = now - msg.received
+        if self.inbound_lag < self.cfg.lag_warning:
+            return
+        if now - self.lag_warned < 300:
+            return
+        self.lag_warned = now
+        warning = "Dispatch is {0:.0f}s behind, {1} messages queued".format(
+                self.inbound_lag, len(self.inbox().q))
+        log.warning(warning)
+        for owner in self.cfg.owners:
+            self.notice(owner, warning)
 
     def action(self, recip, text):
         self.writer.action(recip, text)
@@ -571,8 +3145,16 @@ class Client(object):
     def notice(self, recip, text):
         self.writer.notice(recip, text)
 
-    def write(self, args, text=None):
-        self.writer.write(args, text)
+    def write(self, args, text=None, lane=None):
+        self.writer.write(args, text, lane)
+
+    def queue_stats(self):
+        return self.writer.q.stats()
+
+    @property
+    def lag(self):
+        "Round trip of the last lag probe in seconds, None before the first."
+        return self.rate.lag
 
     def style(self, name=None):
         if name is None:
@@ -634,6 +3216,50 @@ class Client(object):
             return str(day_diff/365) + " years ago"
 
 
+class HostClient(Client):
+    """\
+    Stands in for the Client inside a plugin host process. There is no
+    connection here, lines are passed back to the bot to be sent.
+    """
+
+    def __init__(self, cfg, send):
+        self.cfg = cfg
+        self.send = send
+        self.nick = cfg.nick
+        self.registration = None
+        self.rate = RateController(cfg.rate_profile)
+        self.channels = set()
+        self.recorder = FlightRecorder(cfg.trace_buffer)
+
+    def action(self, recip, text):
+        self.msg(recip, "\001ACTION {0}\001".format(text))
+
+    def msg(self, recip, text):
+        self.write(('PRIVMSG', recip), text)
+
+    def notice(self, recip, text):
+        self.write(('NOTICE', recip), text)
+
+    def write(self, args, text=None):
+        self.send({"write": [args, text]})
+
+    def queue_stats(self):
+        return {}
+
+
+class HostRouter(object):
+    "Registers a plugin host's subscriptions with the bot."
+
+    def __init__(self, send):
+        self.send = send
+
+    def subscribe(self, sub):
+        self.send({"subscribe": [sub.id, sub.keys, sub.once]})
+
+    def unsubscribe(self, sub):
+        self.send({"unsubscribe": sub.id})
+
+
 def options():
     return [
         op.make_option('-v', '--verbose', dest='verbose', default=False,
@@ -642,16 +3268,154 @@ def options():
         op.make_option('--trace', dest='trace', default=False,
             action="store_true",
             help="Enable message tracing"),
+        op.make_option('--trace-sample', dest='trace_sample', default=None,
+            type="int", metavar="N",
+            help="Log every Nth recorded line and dispatch decision"),
         op.make_option('-c', '--config', dest='config', default=None,
             metavar="FILE",
             help="Path to config file"),
         op.make_option('--check', dest='check', default=False,
             action="store_true",
-            help="Try loading each plugin and then exit.")
+            help="Try loading each plugin and then exit."),
+        op.make_option('--resume', dest='resume', default=None,
+            help=op.SUPPRESS_HELP),
+        op.make_option('--host', dest='host', default=None,
+            help=op.SUPPRESS_HELP)
     ]
 
 
+def host(cfg, fname):
+    """\
+    Body of a plugin host process. The pipe to the bot is stdout, so
+    anything the plugin prints is sent to stderr instead.
+    """
+    out = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    lock = threading.Lock()
+
+    def send(obj):
+        with lock:
+            try:
+                out.write(json.dumps(obj) + "\n")
+                out.flush()
+            except IOError:
+                # The bot has gone away, stdin will tell us soon
+                pass
+
+    root = logging.getLogger()
+    root.addHandler(PipeHandler(send))
+    cli = HostClient(cfg, send)
+    code = CodeCache(cfg.cache_dir)
+    storage = Storage(cfg.store, cfg.store_delay)
+
+    def plugin():
+        p = Plugin(cfg, cli, None, fname)
+        p.subscriptions.router = HostRouter(send)
+        p.code = code
+        p.store.storage = storage
+        return p
+
+    def describe(p):
+        desc = []
+        for a in p.actions:
+            if isinstance(a, Command):
+                (kind, spec) = ("command", a.cmd)
+            else:
+                (kind, spec) = ("rule", a.source)
+            desc.append({
+                "kind": kind,
+                "spec": spec,
+                "name": a.name,
+                "docs": a.docs,
+                "event": a.event,
+                "require_owner": a.require_owner
+            })
+        send({"doc": p.data.get("__doc__"), "actions": desc})
+
+    p = plugin()
+    try:
+        p.load()
+    except:
+        send({"error": traceback.format_exc()})
+        return
+    describe(p)
+    for line in iter(sys.stdin.readline, ""):
+        req = json.loads(line)
+        if req.get("unload"):
+            break
+        if req.get("reload"):
+            q = plugin()
+            try:
+                if not q.reload(p):
+                    (old, p) = (p, None)
+                    old.unload()
+                    q.start()
+            except:
+                send({"error": traceback.format_exc()})
+                break
+            p = q
+            describe(p)
+            continue
+        cli.nick = req["nick"]
+        if cli.nick != p.nick:
+            p.renick(cli.nick)
+        msg = Message(cli, req["raw"])
+        if "deliver" in req:
+            sub = p.subscriptions.subs.get(req["deliver"])
+            if sub is not None:
+                p.deliver(sub, msg)
+            continue
+        action = p.actions[req["call"]]
+        try:
+            p.run(action, msg, [action.regexps[req["regexp"]]])
+        except StopIteration:
+            pass
+    if p is not None:
+        p.unload()
+
+
+def close_fds(keep):
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = range(3, min(os.sysconf("SC_OPEN_MAX"), 65536))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def restart(cli, pm):
+    log.info("Restarting")
+    pm.unload()
+    argv = [sys.executable, os.path.abspath(sys.argv[0])]
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "--resume":
+            next(args, None)
+        elif not arg.startswith("--resume="):
+            argv.append(arg)
+    keep = []
+    state = cli.handoff()
+    if state is None:
+        log.info("Connection can't be handed over, reconnecting")
+        cli.close()
+    else:
+        (fd, fname) = tempfile.mkstemp(prefix="gizzy-", suffix=".json")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(state, handle)
+        argv.extend(["--resume", fname])
+        keep.append(state["fd"])
+    logging.shutdown()
+    close_fds(keep)
+    os.execv(sys.executable, argv)
+
+
 def main():
+    started = time.time()
     cfg = Config()
 
     usage = "usage: %prog [options]"
@@ -671,25 +3435,65 @@ def main():
 
     if opts.config is not None:
         cfg.load(opts.config)
+    if opts.trace_sample is not None:
+        cfg.data["trace_sample"] = opts.trace_sample
 
-    logging.basicConfig(
-            level=level,
-            format=logfmt,
-            filename=cfg.logfile
-        )
+    if opts.host is not None:
+        logging.getLogger().setLevel(level)
+        host(cfg, opts.host)
+        return
+
+    if cfg.logfile is not None:
+        output = logging.FileHandler(cfg.logfile)
+    else:
+        output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter(logfmt))
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(output))
+    root.setLevel(level)
 
     cli = Client(cfg)
     pm = PluginManager(cfg, cli)
     pm.load()
 
     if opts.check:
-        log.info("Finished check.")
+        pm.wait()
+        log.info("Finished check in {0:.2f}s".format(time.time() - started))
         return
+    log.info("Plugins loaded in {0:.2f}s, {1} deferred".format(
+            time.time() - started, len(pm.pending)))
 
-    cli.connect()
+    resume = None
+    if opts.resume is not None:
+        with open(opts.resume) as handle:
+            resume = json.load(handle)
+        os.unlink(opts.resume)
 
-    for msg in cli.messages():
-        pm.handle(msg)
+    backoff = Backoff(cfg.reconnect_delay, cfg.reconnect_max_delay)
+    while True:
+        try:
+            if resume is not None:
+                cli.resume(resume)
+                resume = None
+            else:
+                cli.connect()
+        except socket.error, e:
+            log.error("Connection failed: {0}".format(e))
+        else:
+            try:
+                for msg in cli.messages():
+                    pm.handle(msg)
+            except Restart:
+                restart(cli, pm)
+            cli.close()
+            log.warning("Disconnected from {0}".format(cfg.host))
+            if time.time() - cli.connected_at > 60:
+                backoff.reset()
+        if not cfg.reconnect:
+            break
+        delay = backoff.next()
+        log.info("Reconnecting in {0:.1f}s".format(delay))
+        time.sleep(delay)
 
 
 if __name__ == '__main__':
@@ -16,7 +16,7 @@ LEVELS = {
 }
 
 
-@command(["log", "<level>"], require_owner=True)
+@command(["log", "<level>"], require_owner=True, inline=True)
 def loglevel(msg, client):
     level = msg.group("level").upper()
     if level in LEVELS:
@@ -15,6 +15,11 @@ from math import ceil, floor
 from numpy import dot
 from numpy.linalg import norm
 
+# spaCy parsing and the vocabulary sorts are CPU heavy, keep them out
+# of the bot's process. Loading spaCy takes a while so don't wait for it.
+isolate = True
+defer = True
+
 bold = irc.style("bold")
 underline = irc.style("underline")
 
@@ -22,18 +27,6 @@ def constant_factory(value):
     """Helper to construct constant value defaultdicts"""
     return repeat(value).next
 
-def gamethread(func):
-    """Decorator for functions that are Timer game threads.
-    Thread removes self from registry of threads in module state."""
-    def new_func(*args, **kwargs):
-        state = args[1]
-        state['threads'].pop(threading.current_thread().ident, None)
-        func(*args, **kwargs)
-    new_func.__name__ = func.__name__
-    new_func.__doc__ = func.__doc__
-    new_func.__dict__.update(func.__dict__)
-    return new_func
-
 def generate_madlib(state):
     """Generates a Mad Lib from a line out of the chosen corpus."""
     line = None
@@ -102,13 +95,11 @@ def generate_madlib(state):
     state['textshape'] = slots
 
 
-@gamethread
 def warntime(msg, state):
     msg.reply(bold + "*** {} second warning! ***".format(
             state['options']['warntime']) + bold
     )
 
-@gamethread
 def startround(msg, state):
     "Start a round of Mad Libs. "
     state['round'] += 0.25
@@ -151,28 +142,22 @@ def startround(msg, state):
             "{} seconds".format(entrytime)
     )
 
-    t = threading.Timer(
+    state['jobs'].append(schedule.after(
             entrytime,
-            voteround,
-            args=(msg, state)
-    )
-    t.start()
-    state['threads'][t.ident] = t
-    t2 = threading.Timer(
+            voteround, msg, state
+    ))
+    state['jobs'].append(schedule.after(
             entrytime - state['options']['warntime'],
-            warntime,
-            args=(msg, state)
-    )
-    t2.start()
-    state['threads'][t2.ident] = t2
+            warntime, msg, state
+    ))
     if not state['options']['botplays']:
         return
+    # Takes a long while, keep it off the scheduler
     t3 = threading.Thread(
             target=botentry,
             args=(msg, state)
     )
     t3.start()
-    state['threads'][t3.ident] = t3
 
 def processentry(msg, state):
     "Process a submitted Mad Lib word list entry."
@@ -227,7 +212,6 @@ def processentry(msg, state):
                 ", unexpected error")
         log.error(str(e))
 
-@gamethread
 def botentry(msg, state):
     """Generate a response based on the original text.
     Warning, may take 30-60s to complete. Do not set entrytime
@@ -279,7 +263,6 @@ def botentry(msg, state):
     state['entries'].append((config.nick, entry, 0))
     # no entry in state['votes']
 
-@gamethread
 def voteround(msg, state):
     "Start the voting portion of a Mad Libs round."
     state['round'] += 0.5
@@ -314,20 +297,14 @@ def voteround(msg, state):
             "{} seconds".format(votetime)
     )
 
-    t = threading.Timer(
+    state['jobs'].append(schedule.after(
             votetime,
-            endround,
-            args=(msg, state)
-    )
-    t.start()
-    state['threads'][t.ident] = t
-    t2 = threading.Timer(
+            endround, msg, state
+    ))
+    state['jobs'].append(schedule.after(
             votetime - state['options']['warntime'],
-            warntime,
-            args=(msg, state)
-    )
-    t2.start()
-    state['threads'][t2.ident] = t2
+            warntime, msg, state
+    ))
 
 def processvote(msg, state):
     "Process a vote for a Mad Libs entry."
@@ -359,7 +336,6 @@ def processvote(msg, state):
         )
         log.error(str(e))
 
-@gamethread
 def endround(msg, state):
     "End a round of Mad Libs."
     state['round'] += 0.25
@@ -401,13 +377,10 @@ def endround(msg, state):
                 state['options']['numrounds'],
                 state['options']['intertime']
         ))
-        t = threading.Timer(
+        state['jobs'].append(schedule.after(
                 state['options']['intertime'],
-                startround,
-                args=(msg, state)
-        )
-        t.start()
-        state['threads'][t.ident] = t
+                startround, msg, state
+        ))
 
 def endgame(msg, state):
     "End a game of Mad Libs."
@@ -463,6 +436,11 @@ def endgame(msg, state):
             msg.reply("{:>15}: {:>2}".format(slist[0][0], slist[0][1]))
             log.info("{:>15}: {:>2}".format(slist[0][0], slist[0][1]))
             del slist[0]
+
+    totals = store.get('scores', {})
+    for nick, score in state['scores'].items():
+        totals[nick] = totals.get(nick, 0) + score
+    store['scores'] = totals
         
     # be safe, kill any lingering threads
     killgame(state)
@@ -470,12 +448,12 @@ def endgame(msg, state):
 def killgame(state, reset=True):
     if state['round'] == 0:
         return
-    for t in state['threads'].itervalues():
-        try:
-            t.cancel()
-        except AttributeError:
-            continue
+    for job in state['jobs']:
+        job.cancel()
+    state['jobs'] = []
     if reset:
+        if state['subscription'] is not None:
+            state['subscription'].cancel()
         resetstate(state)
     log.info("Game killed.")
 
@@ -493,12 +471,14 @@ def resetstate(state):
         'votes': defaultdict(constant_factory(-1)),
         # Scores: { nick: score, ... }
         'scores': defaultdict(int),
-        # Threads on timers, keyed by thread ident
-        'threads': {},
+        # Scheduled jobs for the game's timers
+        'jobs': [],
         # Absolute path to corpus file
         'corpus': None,
         # set of skippers
-        'skippers': set()
+        'skippers': set(),
+        # Private message subscription while a game is running
+        'subscription': None
     })
 
 
@@ -511,13 +491,12 @@ def startgame(msg, state):
             state['options']['intertime']
     ))
     state['round'] = 0.75
-    t = threading.Timer(
+    if state['subscription'] is None:
+        state['subscription'] = subscribe.private(process)
+    state['jobs'].append(schedule.after(
             state['options']['intertime'],
-            startround,
-            args=(msg, state)
-    )
-    t.start()
-    state['threads'][t.ident] = t
+            startround, msg, state
+    ))
 
 @command(["madlibs", "state"], require_owner=True)
 def dumpstate(msg, state):
@@ -556,8 +535,21 @@ def setoption(msg, state):
         else:
             # ???
             return
+        store['options'] = state['options']
         msg.reply("Mad Libs option {0} set to {1}.".format(key, value))
 
+@command(["madlibs", "scores"])
+def showscores(msg, state):
+    "Show the all time high scores"
+    totals = store.get('scores', {})
+    if not totals:
+        msg.reply("Nobody has played Mad Libs yet.")
+        return
+    slist = sorted(totals.items(), key=lambda k: k[1], reverse=True)
+    msg.reply("Mad Libs high scores: " + ", ".join(
+            "{0}: {1}".format(nick, score) for nick, score in slist[:10]
+    ))
+
 @command(["<blah:madlibs (stop|kill)game>"], require_owner=True)
 def stopgame(msg, state):
     "Stop a game in progress."
@@ -565,11 +557,10 @@ def stopgame(msg, state):
         killgame(state)
         msg.reply(bold + "Game halted by request." + bold)
 
-@rule(".*")
 def process(msg, state):
     "Handle entry and vote submissions."
-    if msg.sender[0] == "#" or state['round'] == 0:
-        # ignore if no game running or if public utterance
+    if state['round'] == 0:
+        # ignore if no game running
         return
     if state['round'] % 1 == 0:
         # Entry submission phase
@@ -601,8 +592,22 @@ def load():
                     "imhotep", "shumway", "dodonga"]
         }
     }
+    # options changed with "madlibs option" outlast restarts
+    for k, v in store.get('options', {}).items():
+        if k in statedict['options']:
+            statedict['options'][k] = v
     resetstate(statedict)
     return statedict
 
+def reload(state):
+    """Keep the word list and any game in progress, its timers and
+    subscription carry over to the new code. Pick up new defaults."""
+    defaults = load()
+    for k, v in defaults['options'].items():
+        state['options'].setdefault(k, v)
+    for k, v in defaults.items():
+        state.setdefault(k, v)
+    return state
+
 def unload(state):
     killgame(state)
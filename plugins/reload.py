@@ -25,17 +25,41 @@ def sync(msg):
         msg.respond(err)
 
 
-@command(["reload"], require_owner=True)
+@command(["reload"], require_owner=True, inline=True)
 def reload(msg):
-    "Reload all plugins"
+    "Reload plugins that changed on disk"
     msg.respond("reloading...")
-    plugin_manager.load()
-    msg.respond("reloaded")
+    report(msg, plugin_manager.load())
     raise StopIteration
 
 
-@command(["restart"], require_owner=True)
+@command(["reload", "<name>"], require_owner=True, inline=True)
+def reload_plugin(msg):
+    "Reload the named plugin"
+    name = msg.group("name")
+    known = set(p.name for p in plugin_manager.plugins)
+    known.update(plugin_manager.plugin_name(f) for f in plugin_manager.files())
+    if name not in known:
+        msg.respond("Unknown plugin: {0}".format(name))
+        return
+    report(msg, plugin_manager.load([name]))
+    raise StopIteration
+
+
+def report(msg, changes):
+    (loaded, unloaded) = changes
+    failed = sorted(set(unloaded) - set(loaded))
+    if loaded:
+        msg.respond("reloaded: {0}".format(", ".join(sorted(loaded))))
+    if failed:
+        msg.respond("unloaded: {0}".format(", ".join(failed)))
+    if not loaded and not failed:
+        msg.respond("nothing to reload")
+
+
+@command(["restart"], require_owner=True, inline=True)
 def restart(msg):
     "Restart to pick up a new config and/or kernel"
-    exit(0)
+    msg.respond("restarting...")
+    raise Restart()
 
@@ -0,0 +1,21 @@
+"""\
+Inspect the flight recorder of recent IRC traffic and dispatch
+decisions.
+"""
+
+import logging
+
+
+@command(["trace", "dump"], require_owner=True)
+def dump(msg):
+    "Write the recorded traffic to the log"
+    reason = "requested by {0}".format(msg.nick)
+    irc.recorder.dump(reason, level=logging.WARNING, full=True)
+    msg.respond("Flight recorder dumped to the log.")
+
+
+@command(["trace", "sample", "<every:\d+>"], require_owner=True)
+def sample(msg):
+    "Log every Nth recorded event, 0 turns sampling off"
+    irc.recorder.sample = int(msg.group("every"))
+    msg.respond("Trace sampling set to: {0}".format(irc.recorder.sample))
@@ -12,6 +12,14 @@ import BeautifulSoup
 import requests
 
 
+# Fetching a tweet can take a while, so run a couple at once but keep
+# the replies in each channel in the order the links were posted.
+concurrency = 2
+
+# Seconds to wait on twitter.com before giving up on a link
+FETCH_TIMEOUT = 10
+
+
 # John Gruber's URL regular expression
 # http://daringfireball.net/2010/07/improved_regex_for_matching_urls
 URL_RE = re.compile(u"""
@@ -45,7 +53,7 @@ URL_RE = re.compile(u"""
 """, re.VERBOSE)
 
 
-@rule("twitter.com")
+@rule("twitter.com", order="target")
 def twitterize(msg):
     "Fetch and display any linked tweets."
     match = URL_RE.search(msg.text)
@@ -66,7 +74,11 @@ def twitterize(msg):
 
 
 def get_tweet(url):
-    r = requests.get(url)
+    try:
+        r = requests.get(url, timeout=FETCH_TIMEOUT)
+    except requests.RequestException as e:
+        log.info("Error fetching {0}: {1}".format(url, e))
+        return
     if r.status_code > 299:
         return
     soup = BeautifulSoup.BeautifulSoup(r.text)
@@ -10,6 +10,9 @@ import requests
 TREE_URL = "https://api.github.com/repos/davisp/gizzy-woof/git/trees/master"
 IMG_BASE_URL = "https://raw.githubusercontent.com/davisp/gizzy-woof/master/{0}"
 
+# Fetching the list of pictures shouldn't hold up connecting
+defer = True
+
 
 def load():
     r = requests.get(TREE_URL)